@@ -73,7 +73,12 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
             'filename': DEFAULT_FILENAME,
             'no_modules': True,
             'no_abstracts': True,
-            'overwrite_html': False})
+            'overwrite_html': False,
+            'workers': 1,
+            'itersize': 2000,
+            'use_cache': False,
+            'unique_abstracts': False,
+            'batch_size': None})
         self.assertEqual(result, 'run cnxupgrade.upgrades.to_html')
 
     def test_to_html_with_id_select_query(self):
@@ -94,7 +99,12 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
             'filename': DEFAULT_FILENAME,
             'no_modules': True,
             'no_abstracts': True,
-            'overwrite_html': False})
+            'overwrite_html': False,
+            'workers': 1,
+            'itersize': 2000,
+            'use_cache': False,
+            'unique_abstracts': False,
+            'batch_size': None})
         self.assertEqual(result, 'run cnxupgrade.upgrades.to_html')
 
     def test_to_html_force_overwrite_html(self):
@@ -116,7 +126,12 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
             'filename': DEFAULT_FILENAME,
             'no_modules': True,
             'no_abstracts': True,
-            'overwrite_html': True})
+            'overwrite_html': True,
+            'workers': 1,
+            'itersize': 2000,
+            'use_cache': False,
+            'unique_abstracts': False,
+            'batch_size': None})
         self.assertEqual(result, 'run cnxupgrade.upgrades.to_html')
 
     def test_to_html_specify_filename(self):
@@ -137,7 +152,36 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
             'filename': 'a.cnxml',
             'no_modules': True,
             'no_abstracts': True,
-            'overwrite_html': False})
+            'overwrite_html': False,
+            'workers': 1,
+            'itersize': 2000,
+            'use_cache': False,
+            'unique_abstracts': False,
+            'batch_size': None})
+        self.assertEqual(result, 'run cnxupgrade.upgrades.to_html')
+
+    def test_to_html_with_workers(self):
+        # Mock to_html.cli_command
+        to_html = self.mock('to_html')
+
+        # Invoke cnx-upgrade to_html
+        result = self.call_target(['to_html', '--workers', '4'])
+
+        # Assert to_html.cli_command was called
+        self.assertEqual(self.call_count, 1)
+        self.assertEqual(self.kwargs['workers'], 4)
+        self.assertEqual(result, 'run cnxupgrade.upgrades.to_html')
+
+    def test_to_html_with_cache(self):
+        # Mock to_html.cli_command
+        to_html = self.mock('to_html')
+
+        # Invoke cnx-upgrade to_html
+        result = self.call_target(['to_html', '--cache'])
+
+        # Assert to_html.cli_command was called
+        self.assertEqual(self.call_count, 1)
+        self.assertEqual(self.kwargs['use_cache'], True)
         self.assertEqual(result, 'run cnxupgrade.upgrades.to_html')
 
     def test_v1(self):
@@ -175,6 +219,24 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
             'db_conn_str': DB_CONNECTION_STRING})
         self.assertEqual(result, 'run cnxupgrade.upgrades.migrate_hit_counts')
 
+    def test_cnxml_census(self):
+        # Mock cnxml_census.cli_command
+        cnxml_census = self.mock('cnxml_census')
+
+        # Invoke cnx-upgrade cnxml_census
+        result = self.call_target(['cnxml_census', '--recount'])
+
+        # Assert cnxml_census.cli_command was called
+        self.assertEqual(self.call_count, 1)
+        self.assertEqual(self.kwargs, {
+            'cmmd': cnxml_census,
+            'db_conn_str': DB_CONNECTION_STRING,
+            'recount': True,
+            'itersize': 2000,
+            'batch_size': 1000,
+            })
+        self.assertEqual(result, 'run cnxupgrade.upgrades.cnxml_census')
+
     def test_create_collection_minor_versions(self):
         # Mock create_collection_minor_versions.cli_command
         create_collection = self.mock('create_collection_minor_versions')
@@ -189,6 +251,13 @@ class CommandLineInterfaceTestCase(unittest.TestCase):
             'cmmd': create_collection,
             'db_conn_str': DB_CONNECTION_STRING,
             'id_select_query': 'select 2',
+            'itersize': 2000,
+            'plan': None,
+            'apply_plan': None,
+            'commit_every': 10,
+            'commit_interval': None,
+            'workers': 1,
+            'revision_index': False,
             })
         self.assertEqual(result, 'run cnxupgrade.upgrades.create_collection_minor_versions')
 
@@ -48,10 +48,10 @@ INSERT INTO module_files (fileid, module_ident, filename, uuid) VALUES (1, 1, 'i
     def tearDown(self):
         self.fixture.tearDown()
 
-    def call_target(self):
+    def call_target(self, **kwargs):
         from ..upgrades.cnxml7.main import main
         with psycopg2.connect(DB_CONNECTION_STRING) as db_conn:
-            return list(main(db_conn))
+            return list(main(db_conn, **kwargs))
 
     @db_connect
     def get_new_cnxml(self, cursor):
@@ -68,6 +68,128 @@ INSERT INTO module_files (fileid, module_ident, filename, uuid) VALUES (1, 1, 'i
         self.assertEqual(result, [('m10470', '2.2', 1, u'0.5', True, '')])
         self.assertTrue('cnxml-version="0.7"' in self.get_new_cnxml())
 
+    def test_successful_with_workers(self):
+        self.setup_test_data('m10470', '2.2')
+
+        result = self.call_target(workers=2,
+                                  connection_string=DB_CONNECTION_STRING)
+
+        self.assertEqual(result, [('m10470', '2.2', 1, u'0.5', True, '')])
+        self.assertTrue('cnxml-version="0.7"' in self.get_new_cnxml())
+
+    @db_connect
+    def insert_file(self, cursor, file):
+        cursor.execute('INSERT INTO files (file) VALUES (%s) '
+                       'RETURNING fileid', (memoryview(file),))
+        return cursor.fetchone()[0]
+
+    @db_connect
+    def get_new_cnxml_fileid(self, cursor):
+        cursor.execute("SELECT fileid FROM module_files "
+                       "WHERE filename = 'index_auto_generated.cnxml'")
+        return cursor.fetchone()[0]
+
+    def test_identical_file_reused(self):
+        self.setup_test_data('m11425', '1.19')
+        from ..upgrades.cnxml7.main import process_document
+        new_cnxml = process_document(get_data_file('m11425-1.19.cnxml'))[3]
+        fileid = self.insert_file(new_cnxml)
+
+        result = self.call_target()
+
+        self.assertEqual(result, [('m11425', '1.19', 1, u'0.7', True, '')])
+        self.assertEqual(self.get_new_cnxml_fileid(), fileid)
+
+    def test_successful_with_stats(self):
+        self.setup_test_data('m10470', '2.2')
+        from ..upgrades.cnxml7.stats import RunStats
+        stats = RunStats()
+
+        result = self.call_target(stats=stats)
+
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0][:6], ('m10470', '2.2', 1, u'0.5', True, ''))
+        self.assertEqual(len(result[0]), 6 + len(stats.columns))
+        self.assertEqual(stats.count, 1)
+
+    @db_connect
+    def get_progress(self, cursor):
+        cursor.execute("SELECT module_ident, source_md5 IS NOT NULL, "
+                       "cnxml_version, state FROM cnxml7_progress")
+        return cursor.fetchall()
+
+    @db_connect
+    def count_new_cnxml(self, cursor):
+        cursor.execute("SELECT count(*) FROM module_files "
+                       "WHERE filename = 'index_auto_generated.cnxml'")
+        return cursor.fetchone()[0]
+
+    def test_incremental(self):
+        self.setup_test_data('m10470', '2.2')
+
+        result = self.call_target(incremental=True)
+
+        self.assertEqual(result, [('m10470', '2.2', 1, u'0.5', True, '')])
+        self.assertEqual(self.get_progress(), [(1, True, '0.5', True)])
+
+        # A second run has nothing left to do.
+        result = self.call_target(incremental=True)
+
+        self.assertEqual(result, [])
+        self.assertEqual(self.count_new_cnxml(), 1)
+
+    @db_connect
+    def fail_progress(self, cursor):
+        cursor.execute("UPDATE cnxml7_progress SET state = FALSE")
+        cursor.execute("DELETE FROM module_files "
+                       "WHERE filename = 'index_auto_generated.cnxml'")
+
+    def test_incremental_retries_failures(self):
+        self.setup_test_data('m10470', '2.2')
+        self.call_target(incremental=True)
+        self.fail_progress()
+
+        result = self.call_target(incremental=True)
+
+        self.assertEqual(result, [('m10470', '2.2', 1, u'0.5', True, '')])
+        self.assertEqual(self.get_progress(), [(1, True, '0.5', True)])
+
+    def test_incremental_already_generated(self):
+        self.setup_test_data('m10470', '2.2')
+        self.call_target()
+
+        result = self.call_target(incremental=True)
+
+        self.assertEqual(result, [])
+        self.assertEqual(self.count_new_cnxml(), 1)
+
+    def take_census(self):
+        from ..upgrades.cnxml_census import take_census
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_conn:
+            list(take_census(db_conn))
+
+    def test_cnxml_versions(self):
+        self.setup_test_data('m10470', '2.2')
+        self.take_census()
+
+        self.assertEqual(self.call_target(cnxml_versions=['0.6', '0.7']), [])
+        self.assertEqual(self.count_new_cnxml(), 0)
+
+        result = self.call_target(cnxml_versions=['0.5'], incremental=True)
+
+        self.assertEqual(result, [('m10470', '2.2', 1, u'0.5', True, '')])
+        self.assertTrue('cnxml-version="0.7"' in self.get_new_cnxml())
+
+    def test_successful_within_budget(self):
+        self.setup_test_data('m10470', '2.2')
+
+        result = self.call_target(time_limit=60,
+                                  memory_limit=1024 * 1024 * 1024,
+                                  connection_string=DB_CONNECTION_STRING)
+
+        self.assertEqual(result, [('m10470', '2.2', 1, u'0.5', True, '')])
+        self.assertTrue('cnxml-version="0.7"' in self.get_new_cnxml())
+
     def test_no_upgrade_necessary(self):
         self.setup_test_data('m11425', '1.19')
 
@@ -117,3 +239,302 @@ class TransformsTestCase(unittest.TestCase):
         self.assertTrue('cnxml-version="0.7"' in new_cnxml)
         # Assert generated cnxml is valid xml
         self.assertTrue(lxml.etree.fromstring(new_cnxml) is not None)
+
+
+class UpgradeDocumentTreeTestCase(unittest.TestCase):
+    """Tests for cnxupgrade.upgrades.cnxml7.transforms.upgrade_document_tree
+    """
+
+    def call_target(self, source, version=None):
+        from ..upgrades.cnxml7 import transforms
+        return transforms.upgrade_document_tree(source, version=version)
+
+    def serialize(self, doc):
+        from ..upgrades.cnxml7.utils import serialize_xml
+        return serialize_xml(doc)
+
+    def test_no_upgrade_necessary(self):
+        cnxml = get_data_file('m11425-1.19.cnxml')
+        doc, result, message = self.call_target(cnxml, version='0.7')
+        self.assertEqual(message, '')
+        self.assertEqual(result, True)
+        self.assertTrue('cnxml-version="0.7"' in self.serialize(doc))
+
+    def test_successful(self):
+        cnxml = get_data_file('m10470-2.2.cnxml')
+        doc, result, message = self.call_target(cnxml, version='0.5')
+        self.assertEqual(message, '')
+        self.assertTrue(result)
+        new_cnxml = self.serialize(doc)
+        self.assertTrue('cnxml-version="0.7"' in new_cnxml)
+        # Assert the serialized cnxml is the same as through upgrade_document
+        from ..upgrades.cnxml7.transforms import upgrade_document
+        from ..upgrades.cnxml7.utils import normalize_xml
+        upgraded = normalize_xml(upgrade_document(cnxml, version='0.5')[0])
+        self.assertEqual(lxml.etree.tostring(lxml.etree.fromstring(new_cnxml)),
+                         upgraded)
+
+    def test_invalid_xml(self):
+        doc, result, message = self.call_target('<document>', version='0.7')
+        self.assertEqual(doc, None)
+        self.assertFalse(result)
+
+
+class ScanCnxmlVersionTestCase(unittest.TestCase):
+    """Tests for cnxupgrade.upgrades.cnxml7.utils.scan_cnxml_version
+    """
+
+    def call_target(self, data):
+        from ..upgrades.cnxml7.utils import scan_cnxml_version
+        return scan_cnxml_version(data)
+
+    def test_doctype(self):
+        cnxml = get_data_file('m10470-2.2.cnxml')
+        self.assertEqual(self.call_target(cnxml), '0.5')
+
+    def test_doctype_plus_mathml(self):
+        cnxml = get_data_file('m12563-1.6.cnxml')
+        self.assertEqual(self.call_target(cnxml), '0.5')
+
+    def test_attribute(self):
+        cnxml = get_data_file('m11425-1.19.cnxml')
+        self.assertEqual(self.call_target(cnxml), '0.7')
+
+    def test_agrees_with_recognizer(self):
+        from ..upgrades.cnxml7.utils import determine_cnxml_version
+        for filename in ('m10470-2.2.cnxml', 'm11425-1.19.cnxml',
+                         'm12563-1.6.cnxml',):
+            cnxml = get_data_file(filename)
+            self.assertEqual(self.call_target(cnxml),
+                             determine_cnxml_version(cnxml))
+
+    def test_inconclusive(self):
+        self.assertEqual(self.call_target('<document><title/>'), None)
+        self.assertEqual(self.call_target(
+            '<!DOCTYPE document PUBLIC "-//CNX//DTD CNXML 0.5//EN" "a.dtd">'
+            '<document cnxml-version="0.6">'), None)
+
+
+class DecodeDocumentTestCase(unittest.TestCase):
+    """Tests for cnxupgrade.upgrades.cnxml7.utils.decode_document
+    """
+
+    def call_target(self, data):
+        from ..upgrades.cnxml7.utils import decode_document
+        return decode_document(data)
+
+    def test_utf8(self):
+        self.assertEqual(self.call_target('<d>caf\xc3\xa9</d>'),
+                         '<d>caf\xc3\xa9</d>')
+
+    def test_latin1(self):
+        self.assertEqual(self.call_target('<d>caf\xe9</d>'),
+                         '<d>caf\xc3\xa9</d>')
+
+
+def _sleep(seconds):
+    import time
+    time.sleep(seconds)
+    return seconds
+
+
+def _allocate(size):
+    return len(b' ' * size)
+
+
+def _fail(message):
+    raise ValueError(message)
+
+
+class BudgetedWorkerTestCase(unittest.TestCase):
+    """Tests for cnxupgrade.upgrades.cnxml7.budget.BudgetedWorker
+    """
+
+    def make_one(self, *args, **kwargs):
+        from ..upgrades.cnxml7.budget import BudgetedWorker
+        worker = BudgetedWorker(*args, **kwargs)
+        self.addCleanup(worker.close)
+        return worker
+
+    def test_within_budget(self):
+        worker = self.make_one(_sleep, timeout=10)
+        self.assertEqual(worker(0), (True, 0,))
+        self.assertEqual(worker(0.1), (True, 0.1,))
+
+    def test_time_limit(self):
+        worker = self.make_one(_sleep, timeout=0.5)
+        self.assertEqual(worker(10), (False, 'time limit of 0.5s exceeded',))
+        # The worker is replaced.
+        self.assertEqual(worker(0), (True, 0,))
+
+    def test_memory_limit(self):
+        limit = 512 * 1024 * 1024
+        worker = self.make_one(_allocate, memory_limit=limit)
+        within_budget, result = worker(limit)
+        self.assertFalse(within_budget)
+        self.assertEqual(worker(1024), (True, 1024,))
+
+    def test_error(self):
+        from ..upgrades.cnxml7.budget import WorkerError
+        worker = self.make_one(_fail, timeout=10)
+        within_budget, result = worker('bad document')
+        # A failing target is within the budget, and its process survives.
+        self.assertTrue(within_budget)
+        self.assertTrue(isinstance(result, WorkerError))
+        self.assertEqual(result.message, 'bad document')
+        process = worker._process
+        worker('another bad document')
+        self.assertTrue(worker._process is process)
+
+
+class RunStatsTestCase(unittest.TestCase):
+    """Tests for cnxupgrade.upgrades.cnxml7.stats.RunStats
+    """
+
+    def make_one(self, **kwargs):
+        from ..upgrades.cnxml7.stats import RunStats
+        return RunStats(**kwargs)
+
+    def test_add(self):
+        stats = self.make_one()
+        row = stats.add(1, {'xslt': 0.5, 'input_bytes': 10})
+
+        self.assertEqual(len(row), len(stats.columns))
+        self.assertEqual(row[stats.columns.index('xslt_seconds')],
+                         '0.500000')
+        self.assertEqual(row[stats.columns.index('input_bytes')], 10)
+
+    def test_summary(self):
+        stats = self.make_one(slowest=2)
+        for ident in range(1, 101):
+            stats.add(ident, {'xslt': ident / 100.0})
+
+        summary = '\n'.join(stats.summary())
+        self.assertTrue(summary.startswith('100 documents'))
+        xslt = [line for line in stats.summary()
+                if line.split()[0] == 'xslt'][0]
+        self.assertEqual([float(value) for value in xslt.split()[1:]],
+                         [0.5, 0.95, 0.99, 50.5])
+        self.assertTrue(summary.endswith('  100 1.0000s\n  99 0.9900s'))
+
+    def test_progress(self):
+        from io import BytesIO
+        progress = BytesIO()
+        stats = self.make_one(progress_every=2, progress_file=progress)
+        for ident in range(5):
+            stats.add(ident, {})
+
+        lines = progress.getvalue().splitlines()
+        self.assertEqual([line.split(',')[0] for line in lines],
+                         ['2 documents', '4 documents'])
+
+
+class GetXsltTestCase(unittest.TestCase):
+    """Tests for cnxupgrade.upgrades.cnxml7.utils.get_xslt
+    """
+
+    def call_target(self, stylesheet):
+        from ..upgrades.cnxml7.utils import get_xslt
+        return get_xslt(stylesheet)
+
+    def test_cached(self):
+        from ..upgrades.cnxml7.transforms import UPGRADE_06_TO_07_XSL
+        xslt, messages = self.call_target(UPGRADE_06_TO_07_XSL)
+        self.assertTrue(self.call_target(UPGRADE_06_TO_07_XSL)[0] is xslt)
+
+    def test_recompiled_when_modified(self):
+        import shutil
+        import tempfile
+        from ..upgrades.cnxml7.transforms import UPGRADE_06_TO_07_XSL
+        handle, stylesheet = tempfile.mkstemp(suffix='.xsl')
+        os.close(handle)
+        self.addCleanup(os.remove, stylesheet)
+        shutil.copy(UPGRADE_06_TO_07_XSL, stylesheet)
+
+        xslt, messages = self.call_target(stylesheet)
+        mtime = os.path.getmtime(stylesheet)
+        os.utime(stylesheet, (mtime + 10, mtime + 10))
+
+        self.assertFalse(self.call_target(stylesheet)[0] is xslt)
+
+
+class CatalogResolverTestCase(unittest.TestCase):
+    """Tests for cnxupgrade.upgrades.cnxml7.utils.CatalogResolver
+    """
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        dtd_directory = os.path.join(self.directory, 'example.invalid', 'dtd')
+        os.makedirs(dtd_directory)
+        with open(os.path.join(dtd_directory, 'test.dtd'), 'w') as f:
+            f.write('<!ENTITY % inc SYSTEM "inc.ent">\n%inc;\n')
+        with open(os.path.join(dtd_directory, 'inc.ent'), 'w') as f:
+            f.write('<!ENTITY hello "Hello world">\n')
+
+    def make_parser(self, offline):
+        from ..upgrades.cnxml7.utils import CatalogResolver, XML_PARSER_KWARGS
+        parser = lxml.etree.XMLParser(**XML_PARSER_KWARGS)
+        parser.resolvers.add(CatalogResolver(self.directory, offline))
+        return parser
+
+    def test_resolved_from_catalog(self):
+        parser = self.make_parser(offline=True)
+        doc = lxml.etree.fromstring(
+            '<!DOCTYPE d SYSTEM "http://example.invalid/dtd/test.dtd">'
+            '<d>&hello;</d>', parser)
+        self.assertEqual(doc.text, 'Hello world')
+
+    def test_offline_missing(self):
+        from ..upgrades.cnxml7.utils import MissingFromCatalog
+        parser = self.make_parser(offline=True)
+        with self.assertRaises(MissingFromCatalog):
+            lxml.etree.fromstring(
+                '<!DOCTYPE d SYSTEM "http://example.invalid/dtd/missing.dtd">'
+                '<d>text</d>', parser)
+
+    def test_bundled_catalog(self):
+        from ..upgrades.cnxml7.utils import (CatalogResolver,
+                                             XML_PARSER_KWARGS)
+        parser = lxml.etree.XMLParser(**XML_PARSER_KWARGS)
+        parser.resolvers.add(CatalogResolver(offline=True))
+        # A CNXML 0.5 plus MathML document, using the "m" prefix
+        #   its DTD declares.
+        doc = lxml.etree.fromstring(get_data_file('m12563-1.6.cnxml'),
+                                    parser)
+        self.assertEqual(
+            len(doc.findall('.//{http://www.w3.org/1998/Math/MathML}math')),
+            1)
+        doc = lxml.etree.fromstring(
+            '<!DOCTYPE document PUBLIC "-//CNX//DTD CNXML 0.6//EN" '
+            '"http://cnx.rice.edu/cnxml/0.6/DTD/cnxml_plain.dtd">'
+            '<document>&alpha;&nbsp;</document>', parser)
+        self.assertEqual(doc.text, u'\u03b1\xa0')
+
+    def test_bundled_catalog_namespaces(self):
+        from ..upgrades.cnxml7.utils import (CatalogResolver,
+                                             XML_PARSER_KWARGS)
+        parser = lxml.etree.XMLParser(**XML_PARSER_KWARGS)
+        parser.resolvers.add(CatalogResolver(offline=True))
+        # A legacy document relying on the namespaces its DTD declares,
+        #   parses as if it had declared them itself.
+        body = ('<metadata><md:title>Title</md:title></metadata>'
+                '<content><para id="p1">Text<bib:file/></para>'
+                '<q:problemset/><m:math/></content></document>')
+        doc = lxml.etree.fromstring(
+            '<!DOCTYPE document '
+            'PUBLIC "-//CNX//DTD CNXML 0.5 plus MathML//EN" '
+            '"http://cnx.rice.edu/cnxml/0.5/DTD/cnxml_mathml.dtd">'
+            '<document id="d">' + body, parser)
+        expected = lxml.etree.fromstring(
+            '<document xmlns="http://cnx.rice.edu/cnxml" '
+            'xmlns:md="http://cnx.rice.edu/mdml/0.4" '
+            'xmlns:bib="http://bibtexml.sf.net/" '
+            'xmlns:q="http://cnx.rice.edu/qml/1.0" '
+            'xmlns:m="http://www.w3.org/1998/Math/MathML" '
+            'id="d">' + body)
+        self.assertEqual([el.tag for el in doc.iter()],
+                         [el.tag for el in expected.iter()])
+        self.assertEqual(doc.nsmap, expected.nsmap)
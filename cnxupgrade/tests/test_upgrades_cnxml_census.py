@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+
+"""Tests for cnxupgrade.upgrades.cnxml_census
+"""
+
+import os
+import unittest
+import uuid
+
+import psycopg2
+
+from . import (postgresql_fixture, db_connect, DB_CONNECTION_STRING,
+               TESTING_DATA_DIRECTORY)
+
+
+def get_data_file(filename):
+    path = os.path.join(TESTING_DATA_DIRECTORY, filename)
+    with open(path) as f:
+        return f.read()
+
+
+# The version is past the head that is scanned, so only the expat
+#   based recognizer finds it.
+LATE_VERSION_CNXML = """\
+<?xml version="1.0"?>
+<!-- {} -->
+<document xmlns="http://cnx.rice.edu/cnxml" cnxml-version="0.6">
+  <title>Late</title>
+</document>
+""".format('x' * 5000)
+
+
+class TakeCensusTestCase(unittest.TestCase):
+    fixture = postgresql_fixture
+
+    def setUp(self):
+        self.fixture.setUp()
+        self.setup_test_data()
+
+    @db_connect
+    def setup_test_data(self, cursor):
+        cursor.execute("INSERT INTO abstracts (abstractid, abstract) "
+                       "VALUES (1, '')")
+        self.insert_module(cursor, 1, get_data_file('m10470-2.2.cnxml'))
+        self.insert_module(cursor, 2, get_data_file('m11425-1.19.cnxml'))
+
+    def tearDown(self):
+        self.fixture.tearDown()
+
+    def insert_module(self, cursor, ident, cnxml):
+        document_uuid = str(uuid.uuid4())
+        cursor.execute("INSERT INTO document_controls (uuid) "
+                       "VALUES (%s)", (document_uuid,))
+        cursor.execute(
+            "INSERT INTO modules (module_ident, portal_type, moduleid, "
+            "  uuid, version, name, abstractid, licenseid, doctype) "
+            "VALUES (%s, 'Module', %s, %s, '1.1', 'Module', 1, 11, '')",
+            (ident, 'm{}'.format(ident), document_uuid,))
+        self.insert_file(cursor, ident, cnxml)
+
+    def insert_file(self, cursor, ident, cnxml):
+        cursor.execute("INSERT INTO files (file) VALUES (%s) "
+                       "RETURNING fileid", (memoryview(cnxml),))
+        cursor.execute("INSERT INTO module_files "
+                       "(module_ident, fileid, filename) "
+                       "VALUES (%s, %s, 'index.cnxml')",
+                       (ident, cursor.fetchone()[0],))
+
+    @db_connect
+    def add_module(self, cursor, ident, cnxml):
+        self.insert_module(cursor, ident, cnxml)
+
+    @db_connect
+    def replace_file(self, cursor, ident, cnxml):
+        cursor.execute("DELETE FROM module_files "
+                       "WHERE module_ident = %s", (ident,))
+        self.insert_file(cursor, ident, cnxml)
+
+    @db_connect
+    def get_census(self, cursor):
+        cursor.execute("SELECT v.module_ident, v.cnxml_version "
+                       "FROM cnxml_versions AS v "
+                       "     JOIN module_files AS mf "
+                       "       ON mf.module_ident = v.module_ident "
+                       "          AND mf.fileid = v.fileid "
+                       "ORDER BY v.module_ident")
+        return cursor.fetchall()
+
+    def call_target(self, **kwargs):
+        from ..upgrades.cnxml_census import take_census
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            return list(take_census(db_connection, **kwargs))
+
+    def test_first_count(self):
+        result = self.call_target(itersize=1, batch_size=1)
+
+        self.assertEqual(result, [(1, '0.5'), (2, '0.7')])
+        self.assertEqual(self.get_census(), [(1, '0.5'), (2, '0.7')])
+
+    def test_skip_counted(self):
+        self.call_target()
+        self.add_module(3, get_data_file('m12563-1.6.cnxml'))
+
+        self.assertEqual(self.call_target(), [(3, '0.5')])
+        self.assertEqual(self.call_target(), [])
+
+        # A module whose file changed is counted again.
+        self.replace_file(1, get_data_file('m11425-1.19.cnxml'))
+        self.assertEqual(self.call_target(), [(1, '0.7')])
+        self.assertEqual(self.get_census(),
+                         [(1, '0.7'), (2, '0.7'), (3, '0.5')])
+
+    def test_recount(self):
+        self.call_target()
+
+        result = self.call_target(recount=True, batch_size=1)
+
+        self.assertEqual(result, [(1, '0.5'), (2, '0.7')])
+        self.assertEqual(self.get_census(), [(1, '0.5'), (2, '0.7')])
+
+    def test_fallback(self):
+        self.add_module(3, LATE_VERSION_CNXML)
+
+        result = self.call_target()
+
+        self.assertEqual(result, [(1, '0.5'), (2, '0.7'), (3, '0.6')])
+        self.assertEqual(self.get_census()[2], (3, '0.6'))
@@ -12,6 +12,8 @@ import sys
 import unittest
 import uuid
 
+import psycopg2
+
 from . import postgresql_fixture, db_connect, DB_CONNECTION_STRING
 
 
@@ -30,6 +32,40 @@ class FixDocumentIdMapTestCase(unittest.TestCase):
         self.call_target(m)
         self.assertEqual(m, {1: 5, 2: 4})
 
+    def test_long_chains(self):
+        # e.g. a module edited every week for years
+        m = _CountingDict()
+        for chain in range(10):
+            start = chain * 100000
+            for i in range(start, start + 5000):
+                m[i] = i + 1
+        # and some documents replaced only once
+        m.update({-1: -2, -3: -4})
+        size = len(m)
+        self.call_target(m)
+
+        expected = dict((chain * 100000, chain * 100000 + 5000)
+                        for chain in range(10))
+        expected.update({-1: -2, -3: -4})
+        self.assertEqual(m, expected)
+        # Each chain is followed once, rather than once from every
+        #   document along it.
+        self.assertTrue(m.lookups < 4 * size,
+                        '{} lookups for {} entries'.format(m.lookups, size))
+
+
+class _CountingDict(dict):
+    """A dict that counts the lookups made on it."""
+    lookups = 0
+
+    def __getitem__(self, key):
+        self.lookups += 1
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.lookups += 1
+        return dict.__contains__(self, key)
+
 
 class CollectionMigrationTestCase(unittest.TestCase):
     """Tests for creating collection minor versions for collections that are
@@ -473,6 +509,114 @@ class CollectionMigrationTestCase(unittest.TestCase):
         self.assertEqual(tree[2][2], module_idents[8])
         self.assertEqual(tree[3][2], module_idents[10])
 
+    @db_connect
+    def test_plan(self, cursor):
+        """Test case for planning the minor versions and applying the plan
+        """
+        from ..upgrades.create_collection_minor_versions import (
+            apply_collection_minor_versions_plan, dump_plan,
+            estimate_plan_rows, load_plan, plan_collection_minor_versions)
+        cursor.execute("ALTER TABLE modules DISABLE TRIGGER ALL;")
+        m1_uuid = str(uuid.uuid4())
+        m2_uuid = str(uuid.uuid4())
+        c1_uuid = str(uuid.uuid4())
+        module_idents = list(self.insert_modules(cursor, (
+            ('Module', 'm1', m1_uuid, '1.1', 'Name of module m1',
+                '2013-10-01 11:24:00.000000-07', 1, None),
+            ('Module', 'm2', m2_uuid, '1.1', 'Name of module m2',
+                '2013-10-01 12:24:00.000000-07', 1, None),
+            ('Collection', 'c1', c1_uuid, '1.5', 'Name of collection c1',
+                '2013-10-02 21:43:00.000000-07', 5, 1),
+            ('Module', 'm1', m1_uuid, '1.2', 'Changed name of module m1',
+                '2013-10-03 09:00:00.000000-07', 2, None),
+            )))
+        self.create_collection_tree(cursor, (
+            (None, module_idents[2]),
+            (module_idents[2], module_idents[0]),
+            (module_idents[2], module_idents[1])))
+        cursor.execute('SELECT COUNT(*) FROM modules')
+        old_num_modules = cursor.fetchone()[0]
+
+        plan = plan_collection_minor_versions(cursor, module_idents[2])
+
+        self.assertEqual(len(plan['batches']), 1)
+        batch = plan['batches'][0]
+        self.assertEqual(batch['minor_version'], 2)
+        self.assertEqual(batch['module_idents'], [module_idents[3]])
+        self.assertEqual(batch['replacements'],
+                         [(module_idents[0], module_idents[3])])
+        self.assertEqual(estimate_plan_rows(cursor, plan),
+                         {'modules': 1, 'trees': 3})
+        # Planning does not change anything
+        cursor.execute('SELECT COUNT(*) FROM modules')
+        self.assertEqual(cursor.fetchone()[0], old_num_modules)
+
+        loaded_plan = load_plan(dump_plan(plan), cursor)
+        self.assertEqual(loaded_plan['batches'][0]['revised'],
+                         batch['revised'])
+        apply_collection_minor_versions_plan(cursor, loaded_plan)
+
+        cursor.execute('SELECT module_ident, revised, minor_version '
+                       'FROM modules ORDER BY module_ident DESC LIMIT 1')
+        new_ident, revised, minor_version = cursor.fetchone()
+        self.assertEqual(revised, batch['revised'])
+        self.assertEqual(minor_version, 2)
+        cursor.execute('SELECT documentid FROM trees WHERE parent_id = '
+                       '(SELECT nodeid FROM trees WHERE documentid = %s) '
+                       'ORDER BY childorder', [new_ident])
+        self.assertEqual([row[0] for row in cursor.fetchall()],
+                         [module_idents[3], module_idents[1]])
+
+
+class RevisionIndexTestCase(unittest.TestCase):
+    """Tests for RevisionIndex
+    """
+    fixture = postgresql_fixture
+
+    def setUp(self):
+        self.fixture.setUp()
+
+    def tearDown(self):
+        self.fixture.tearDown()
+
+    @db_connect
+    def test_tree_revisions(self, cursor):
+        from ..upgrades.create_collection_minor_versions import (
+            RevisionIndex, SQL_SELECT_TREE_REVISIONS)
+        cursor.execute("INSERT INTO abstracts VALUES (1, 'abstract')")
+        m1 = str(uuid.uuid4())
+        m2 = str(uuid.uuid4())
+        module_idents = []
+        for moduleid, uuid_, version, revised in (
+                ('m1', m1, '1.1', '2013-01-01 00:00:00+00'),
+                ('m2', m2, '1.1', '2013-01-01 00:00:00+00'),
+                ('m1', m1, '1.2', '2013-01-02 00:00:00.000001+00'),
+                ('m2', m2, '1.2', '2013-01-02 00:00:00+00'),
+                ('m1', m1, '1.3', '2013-01-03 00:00:00+00'),
+                ('m2', m2, '1.3', '2013-02-01 00:00:00+00'),
+                ):
+            cursor.execute('''INSERT INTO modules VALUES (
+            DEFAULT, 'Module', %s, %s, %s, %s,
+            '2013-01-01 00:00:00+00', %s, 1, 11, '', '', '', NULL, NULL,
+            'en', '{}', '{}', '{}', NULL, NULL, NULL, 1, NULL)
+            RETURNING module_ident''',
+                           (moduleid, uuid_, version, moduleid, revised,))
+            module_idents.append(cursor.fetchone()[0])
+        cursor.execute("SELECT '2013-01-01 00:00:00+00'::timestamptz, "
+                       "'2013-01-03 00:00:00+00'::timestamptz")
+        after, before = cursor.fetchone()
+        tree = [module_idents[0], module_idents[1]]
+
+        index = RevisionIndex.load(cursor.connection)
+        cursor.execute(SQL_SELECT_TREE_REVISIONS, [tree, after, before])
+        expected = cursor.fetchall()
+
+        self.assertEqual(len(index), 6)
+        self.assertEqual(index.tree_revisions(cursor, tree, after, before),
+                         expected)
+        self.assertEqual([r[1] for r in expected],
+                         [module_idents[3], module_idents[2]])
+
 
 class CliTestCase(unittest.TestCase):
     """Tests for cli_command
@@ -513,3 +657,116 @@ class CliTestCase(unittest.TestCase):
                 "<type 'psycopg2._psycopg.cursor'>")
         self.assertEqual(self.args[1], 2)
         self.assertEqual(self.kwargs, {})
+
+    @db_connect
+    def get_completed(self, cursor):
+        cursor.execute('SELECT module_ident '
+                       'FROM collection_minor_versions_completed '
+                       'ORDER BY module_ident')
+        return [row[0] for row in cursor.fetchall()]
+
+    def test_skip_completed(self):
+        self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                         id_select_query='select 2')
+        self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                         id_select_query='select 2 union all select 3')
+        self.assertEqual(self.call_count, 2)
+        self.assertEqual(self.args[1], 3)
+        self.assertEqual(self.get_completed(), [2, 3])
+
+    def test_failure(self):
+        from ..upgrades import create_collection_minor_versions as m
+        mock = m.create_collection_minor_versions
+        def failing_mock(cursor, collection_ident, **kwargs):
+            mock(cursor, collection_ident, **kwargs)
+            if collection_ident == 2:
+                cursor.execute('SELECT 1/0')
+        m.create_collection_minor_versions = failing_mock
+
+        self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                         id_select_query='select 2 union all select 3',
+                         commit_every=1)
+        self.assertEqual(self.call_count, 2)
+        self.assertEqual(self.get_completed(), [3])
+
+    @db_connect
+    def add_collection(self, cursor):
+        cursor.execute("INSERT INTO abstracts VALUES (1, 'abstract')")
+        cursor.execute('''INSERT INTO modules VALUES (
+        DEFAULT, 'Collection', 'col1', %s, '1.1', 'col1',
+        '2013-01-01 00:00:00+00', '2013-01-01 00:00:00+00', 1, 11,
+        '', '', '', NULL, NULL, 'en', '{}', '{}', '{}', NULL, NULL,
+        NULL, 1, 1) RETURNING module_ident''', [str(uuid.uuid4())])
+        return cursor.fetchone()[0]
+
+    def test_workers(self):
+        from ..upgrades import create_collection_minor_versions as m
+        m._init_worker(DB_CONNECTION_STRING, {})
+        self.addCleanup(m._worker_connection.close)
+        collection_ident = self.add_collection()
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            with db_connection.cursor() as cursor:
+                cursor.execute(m.SQL_CREATE_COMPLETED_COLLECTIONS)
+            db_connection.commit()
+
+            call = m._create_collection_minor_versions_in_worker
+            self.assertEqual(call(collection_ident),
+                             (collection_ident, m.CLAIMED, None))
+            self.assertEqual(self.args[1], collection_ident)
+
+            # Completed by another process since the run started
+            self.assertEqual(call(collection_ident),
+                             (collection_ident, m.ALREADY_COMPLETED, None))
+
+            # Claimed by another process
+            with db_connection.cursor() as cursor:
+                cursor.execute(m.SQL_TRY_LOCK_COLLECTION, [collection_ident])
+                self.assertTrue(cursor.fetchone()[0])
+                self.assertEqual(call(collection_ident),
+                                 (collection_ident, m.CLAIMED_ELSEWHERE,
+                                  None))
+            db_connection.rollback()
+        self.assertEqual(self.call_count, 1)
+
+    def test_claimed_elsewhere(self):
+        from ..upgrades import create_collection_minor_versions as m
+        collection_ident = self.add_collection()
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            with db_connection.cursor() as cursor:
+                cursor.execute(m.SQL_TRY_LOCK_COLLECTION, [collection_ident])
+                self.assertTrue(cursor.fetchone()[0])
+
+                # Without workers, the collection is claimed all the same.
+                self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                                 id_select_query='select {}'
+                                                 .format(collection_ident))
+            db_connection.rollback()
+        self.assertEqual(self.call_count, 0)
+        self.assertEqual(self.get_completed(), [])
+        self.assertTrue('claimed by another process' in sys.stdout.getvalue())
+
+        self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                         id_select_query='select {}'.format(collection_ident))
+        self.assertEqual(self.call_count, 1)
+        self.assertEqual(self.get_completed(), [collection_ident])
+
+    def test_completed_elsewhere(self):
+        from ..upgrades import create_collection_minor_versions as m
+        collection_ident = self.add_collection()
+        # Completed by another process, after this run has looked at
+        #   the completed collections.
+        original = m._completed_collections
+        self.addCleanup(setattr, m, '_completed_collections', original)
+        def f(db_connection):
+            completed = original(db_connection)
+            with db_connection.cursor() as cursor:
+                cursor.execute(m.SQL_RECORD_COMPLETED_COLLECTION,
+                               [collection_ident])
+            db_connection.commit()
+            return completed
+        m._completed_collections = f
+
+        self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                         id_select_query='select {}'.format(collection_ident))
+        self.assertEqual(self.call_count, 0)
+        self.assertTrue('already completed' in sys.stdout.getvalue())
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+
+"""Tests for cnxupgrade.upgrades.dump_upgrade
+"""
+
+from io import BytesIO
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import uuid
+
+import psycopg2
+
+from . import postgresql_fixture, db_connect, DB_CONNECTION_STRING
+
+
+def parse_copies(dump):
+    """Returns the rows of each COPY block in the ``dump``, by table."""
+    copies = {}
+    rows = None
+    for line in dump.splitlines():
+        if rows is None:
+            if line.startswith('copy ') and line.endswith(' from stdin;'):
+                rows = copies.setdefault(line.split()[1], [])
+        elif line == '\\.':
+            rows = None
+        else:
+            rows.append(line.split('\t'))
+    return copies
+
+
+def first_column(rows):
+    return [row[0] for row in rows]
+
+
+class InIdentOrderTestCase(unittest.TestCase):
+
+    def call_target(self, *args, **kwargs):
+        from ..upgrades.dump_upgrade import in_ident_order
+        return list(in_ident_order(*args, **kwargs))
+
+    def test(self):
+        self.assertEqual(self.call_target([1, 2, 2, 5]), [1, 2, 5])
+
+    def test_out_of_order(self):
+        with self.assertRaises(ValueError):
+            self.call_target([1, 5, 2])
+
+
+class WatermarkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.state_file = os.path.join(self.directory, 'state')
+
+    def test_missing(self):
+        from ..upgrades.dump_upgrade import read_watermark
+        self.assertEqual(read_watermark(self.state_file), None)
+
+    def test_write_and_read(self):
+        from ..upgrades.dump_upgrade import read_watermark, write_watermark
+        write_watermark(self.state_file, 10, [4, 7], 1234)
+
+        self.assertEqual(read_watermark(self.state_file), (10, [4, 7], 1234))
+        self.assertFalse(os.path.exists(self.state_file + '.tmp'))
+
+    def test_write_without_gaps(self):
+        from ..upgrades.dump_upgrade import read_watermark, write_watermark
+        write_watermark(self.state_file, 10)
+
+        self.assertEqual(read_watermark(self.state_file), (10, [], None))
+
+    def test_read_watermark_only(self):
+        # as written before the missing idents were recorded
+        from ..upgrades.dump_upgrade import read_watermark
+        with open(self.state_file, 'w') as f:
+            f.write('10\n')
+
+        self.assertEqual(read_watermark(self.state_file), (10, [], None))
+
+
+class DumpUpgradeTestCase(unittest.TestCase):
+    fixture = postgresql_fixture
+
+    def setUp(self):
+        self.fixture.setUp()
+        self.setup_test_data()
+
+    @db_connect
+    def setup_test_data(self, cursor):
+        # Module 1 is dumped first, module 2 shares its abstract, one of
+        #   its keywords and one of its files.
+        cursor.execute("INSERT INTO abstracts (abstractid, abstract) "
+                       "VALUES (1, 'An abstract')")
+        cursor.execute("INSERT INTO keywords (keywordid, word) "
+                       "VALUES (1, 'physics'), (2, 'optics')")
+        cursor.execute("INSERT INTO files (fileid, file) "
+                       "VALUES (1, %s), (2, %s)",
+                       (memoryview('<document/>'), memoryview('image'),))
+        self.insert_module(cursor, 1)
+        self.insert_module(cursor, 2)
+        cursor.execute("INSERT INTO module_files "
+                       "(module_ident, fileid, filename) "
+                       "VALUES (1, 1, 'index.cnxml'), (2, 1, 'index.cnxml'), "
+                       "       (2, 2, 'image.png')")
+        cursor.execute("INSERT INTO modulekeywords (module_ident, keywordid) "
+                       "VALUES (1, 1), (2, 1), (2, 2)")
+
+    def tearDown(self):
+        self.fixture.tearDown()
+
+    def insert_module(self, cursor, ident):
+        document_uuid = str(uuid.uuid4())
+        cursor.execute("INSERT INTO document_controls (uuid) "
+                       "VALUES (%s)", (document_uuid,))
+        cursor.execute(
+            "INSERT INTO modules (module_ident, portal_type, moduleid, "
+            "  uuid, version, name, abstractid, licenseid, doctype) "
+            "VALUES (%s, 'Module', %s, %s, '1.1', 'Module', 1, 11, '')",
+            (ident, 'm{}'.format(ident), document_uuid,))
+
+    @db_connect
+    def add_module(self, cursor, ident):
+        self.insert_module(cursor, ident)
+
+
+class DumpModulesTestCase(DumpUpgradeTestCase):
+
+    def call_target(self, module_idents):
+        from ..upgrades.dump_upgrade import dump_modules
+        f = BytesIO()
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            with db_connection.cursor() as cursor:
+                dump_modules(cursor, module_idents, f)
+        return parse_copies(f.getvalue())
+
+    def test_first_module(self):
+        copies = self.call_target([1])
+
+        self.assertEqual(first_column(copies['new_abstracts']), ['1'])
+        self.assertEqual(first_column(copies['new_keywords']), ['1'])
+        self.assertEqual(first_column(copies['new_files']), ['1'])
+        self.assertEqual(first_column(copies['new_modules']), ['1'])
+        self.assertEqual(first_column(copies['new_module_files']), ['1'])
+        self.assertEqual(copies['new_modulekeywords'], [['1', '1']])
+
+    def test_later_module(self):
+        # Only what module 1 does not already use is new.
+        copies = self.call_target([2])
+
+        self.assertEqual(copies['new_abstracts'], [])
+        self.assertEqual(first_column(copies['new_keywords']), ['2'])
+        self.assertEqual(first_column(copies['new_files']), ['2'])
+        self.assertEqual(first_column(copies['new_modules']), ['2'])
+        self.assertEqual(copies['new_modulekeywords'],
+                         [['2', '1'], ['2', '2']])
+
+    def test_modules(self):
+        copies = self.call_target([1, 2])
+
+        self.assertEqual(first_column(copies['new_abstracts']), ['1'])
+        self.assertEqual(first_column(copies['new_keywords']), ['1', '2'])
+        self.assertEqual(first_column(copies['new_files']), ['1', '2'])
+        self.assertEqual(first_column(copies['new_modules']), ['1', '2'])
+        self.assertEqual(first_column(copies['new_module_files']),
+                         ['1', '2', '2'])
+
+
+class CliCommandTestCase(DumpUpgradeTestCase):
+
+    def setUp(self):
+        super(CliCommandTestCase, self).setUp()
+        # Capture stderr
+        original_stderr = sys.stderr
+        self.addCleanup(setattr, sys, 'stderr', original_stderr)
+        sys.stderr = BytesIO()
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'dump.sql')
+
+    def call_target(self, **kwargs):
+        from ..upgrades.dump_upgrade import cli_command
+        kwargs.setdefault('id_select_query', 'SELECT module_ident '
+                                             'FROM modules '
+                                             'ORDER BY module_ident')
+        cli_command(db_conn_str=DB_CONNECTION_STRING,
+                    filename=self.filename, **kwargs)
+        with open(self.filename) as f:
+            return f.read()
+
+    def test_chunks(self):
+        dump = self.call_target(chunk_size=1)
+
+        self.assertEqual(dump.count('copy new_modules from stdin;'), 2)
+        self.assertEqual(dump.count('truncate new_abstracts'), 1)
+        copies = parse_copies(dump)
+        self.assertEqual(first_column(copies['new_modules']), ['1', '2'])
+        self.assertEqual(first_column(copies['new_files']), ['1', '2'])
+
+    def test_out_of_order(self):
+        with self.assertRaises(ValueError):
+            self.call_target(id_select_query='SELECT module_ident '
+                                             'FROM modules '
+                                             'ORDER BY module_ident DESC',
+                             chunk_size=1)
+
+    def test_unordered(self):
+        # Without chunks the idents may come in any order, and repeated.
+        dump = self.call_target(id_select_query='SELECT module_ident '
+                                                'FROM modules '
+                                                'UNION ALL SELECT 1 '
+                                                'ORDER BY 1 DESC')
+
+        self.assertEqual(dump.count('copy new_modules from stdin;'), 1)
+        copies = parse_copies(dump)
+        self.assertEqual(first_column(copies['new_modules']), ['1', '2'])
+        self.assertEqual(first_column(copies['new_files']), ['1', '2'])
+
+    @db_connect
+    def get_indexes(self, cursor):
+        cursor.execute("SELECT relname FROM pg_class "
+                       "WHERE relname IN ('module_files_fileid_idx', "
+                       "                  'modules_abstractid_idx') "
+                       "ORDER BY relname")
+        return [row[0] for row in cursor.fetchall()]
+
+    def test_no_indexes_created(self):
+        self.call_target()
+        self.assertEqual(self.get_indexes(), [])
+
+    def test_create_indexes(self):
+        dump = self.call_target(create_indexes=True)
+        self.assertEqual(self.get_indexes(),
+                         ['module_files_fileid_idx', 'modules_abstractid_idx'])
+        self.assertEqual(first_column(parse_copies(dump)['new_modules']),
+                         ['1', '2'])
+
+        # Existing indexes are left alone.
+        self.call_target(create_indexes=True)
+        self.assertEqual(self.get_indexes(),
+                         ['module_files_fileid_idx', 'modules_abstractid_idx'])
+
+    def read_state(self):
+        from ..upgrades.dump_upgrade import read_watermark
+        return read_watermark(os.path.join(self.directory, 'state'))
+
+    def test_state_file(self):
+        state_file = os.path.join(self.directory, 'state')
+        copies = parse_copies(self.call_target(state_file=state_file))
+        self.assertEqual(first_column(copies['new_modules']), ['1', '2'])
+        watermark, gaps, horizon = self.read_state()
+        self.assertEqual((watermark, gaps), (2, []))
+
+        # Nothing new, the id select query is not used again.
+        copies = parse_copies(self.call_target(state_file=state_file,
+                                               id_select_query=None))
+        self.assertEqual(copies, {})
+        self.assertEqual(self.read_state()[:2], (2, []))
+
+        # Module 3 takes its ident, but commits after module 4.
+        self.add_module(4)
+        copies = parse_copies(self.call_target(state_file=state_file))
+        self.assertEqual(first_column(copies['new_modules']), ['4'])
+        watermark, gaps, horizon = self.read_state()
+        self.assertEqual((watermark, gaps), (4, [3]))
+
+        # It is dumped all the same, once it shows up.
+        self.add_module(3)
+        copies = parse_copies(self.call_target(state_file=state_file))
+        self.assertEqual(first_column(copies['new_modules']), ['3'])
+        self.assertEqual(self.read_state()[:2], (4, []))
@@ -10,10 +10,15 @@
 """
 
 from io import BytesIO
+import os
 import sys
 import unittest
+import uuid
 
-from . import DB_CONNECTION_STRING
+import psycopg2
+
+from . import (postgresql_fixture, db_connect, DB_CONNECTION_STRING,
+               TESTING_DATA_DIRECTORY)
 
 class ToHtmlTestCase(unittest.TestCase):
 
@@ -66,7 +71,7 @@ class ToHtmlTestCase(unittest.TestCase):
         self.assertEqual(str(type(self.abstracts_args[0])),
                          "<type 'psycopg2._psycopg.connection'>")
         self.assertEqual(self.abstracts_args[1], 'SELECT 2')
-        self.assertEqual(self.abstracts_kwargs, {})
+        self.assertEqual(self.abstracts_kwargs, {'itersize': 2000})
 
     def test_transform_modules(self):
         self.call_target(db_conn_str=DB_CONNECTION_STRING,
@@ -83,4 +88,498 @@ class ToHtmlTestCase(unittest.TestCase):
                          "<type 'psycopg2._psycopg.connection'>")
         self.assertEqual(self.modules_args[1], 'SELECT 2')
         self.assertEqual(self.modules_kwargs, {
-            'source_filename': 'index.cnxml', 'overwrite_html': False})
+            'source_filename': 'index.cnxml', 'overwrite_html': False,
+            'workers': 1, 'connection_string': DB_CONNECTION_STRING,
+            'itersize': 2000, 'use_cache': False, 'batch_size': None})
+
+    def test_transform_modules_with_workers(self):
+        self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                         id_select_query='SELECT 2',
+                         overwrite_html=False,
+                         filename='index.cnxml',
+                         no_modules=True,
+                         no_abstracts=False,
+                         workers=4)
+
+        self.assertEqual(self.call_modules_count, 1)
+        self.assertEqual(self.modules_kwargs['workers'], 4)
+        self.assertEqual(self.modules_kwargs['connection_string'],
+                         DB_CONNECTION_STRING)
+
+    def test_batch_size_with_cache(self):
+        # Capture stderr
+        original_stderr = sys.stderr
+        self.addCleanup(setattr, sys, 'stderr', original_stderr)
+        sys.stderr = BytesIO()
+
+        result = self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                                  id_select_query='SELECT 2',
+                                  overwrite_html=False,
+                                  filename='index.cnxml',
+                                  no_modules=True,
+                                  no_abstracts=False,
+                                  use_cache=True,
+                                  batch_size=10)
+
+        self.assertEqual(result, 1)
+        self.assertEqual(self.call_modules_count, 0)
+        self.assertTrue('--batch-size' in sys.stderr.getvalue())
+
+    def test_transform_unique_abstracts(self):
+        from ..upgrades import to_html
+        original = to_html.produce_html_for_unique_abstracts
+        self.addCleanup(setattr, to_html,
+                        'produce_html_for_unique_abstracts', original)
+        calls = []
+        def h(*args, **kwargs):
+            calls.append((args, kwargs,))
+            return []
+        to_html.produce_html_for_unique_abstracts = h
+
+        self.call_target(db_conn_str=DB_CONNECTION_STRING,
+                         id_select_query='SELECT 2',
+                         overwrite_html=False,
+                         filename='index.cnxml',
+                         no_modules=False,
+                         no_abstracts=True,
+                         unique_abstracts=True)
+
+        # Assert only produce_html_for_unique_abstracts is called
+        self.assertEqual(self.call_abstracts_count, 0)
+        self.assertEqual(self.call_modules_count, 0)
+        self.assertEqual(len(calls), 1)
+        args, kwargs = calls[0]
+        self.assertEqual(str(type(args[0])),
+                         "<type 'psycopg2._psycopg.connection'>")
+        self.assertEqual(args[1], to_html.make_abstract_select_query(
+            'SELECT 2'))
+        self.assertTrue('IN (SELECT 2)' in args[1])
+        self.assertEqual(kwargs, {'itersize': 2000})
+
+
+def insert_module(cursor, ident, abstractid=None):
+    document_uuid = str(uuid.uuid4())
+    cursor.execute("INSERT INTO document_controls (uuid) "
+                   "VALUES (%s)", (document_uuid,))
+    cursor.execute(
+        "INSERT INTO modules (module_ident, portal_type, moduleid, "
+        "  uuid, version, name, abstractid, licenseid, doctype) "
+        "VALUES (%s, 'Module', %s, %s, '1.1', 'Module', %s, 11, '')",
+        (ident, 'm{}'.format(ident), document_uuid, abstractid,))
+
+
+def insert_module_file(cursor, ident, filename, file, mimetype):
+    cursor.execute("INSERT INTO files (file) VALUES (%s) RETURNING fileid",
+                   (memoryview(file),))
+    fileid = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO module_files "
+                   "(module_ident, fileid, filename, mimetype) "
+                   "VALUES (%s, %s, %s, %s)",
+                   (ident, fileid, filename, mimetype,))
+
+
+class TransformCacheTestCase(unittest.TestCase):
+    """Tests for produce_html_for_modules with the transform cache
+    """
+    fixture = postgresql_fixture
+
+    def setUp(self):
+        self.fixture.setUp()
+
+        # Count the module transforms.
+        from ..upgrades import to_html
+        original = to_html.produce_html_for_module
+        self.addCleanup(setattr, to_html, 'produce_html_for_module',
+                        original)
+        self.transformed = []
+        def f(db_connection, cursor, ident, *args, **kwargs):
+            self.transformed.append(ident)
+            return original(db_connection, cursor, ident, *args, **kwargs)
+        to_html.produce_html_for_module = f
+
+    def tearDown(self):
+        self.fixture.tearDown()
+
+    @db_connect
+    def setup_test_data(self, cursor, idents):
+        """Adds modules at ``idents`` with identical sources."""
+        path = os.path.join(TESTING_DATA_DIRECTORY, 'm10470-2.2.cnxml')
+        with open(path) as f:
+            cnxml = f.read()
+        for ident in idents:
+            insert_module(cursor, ident)
+            insert_module_file(cursor, ident, 'index.cnxml', cnxml,
+                               'text/xml')
+
+    @db_connect
+    def add_module_file(self, cursor, ident, filename, file, mimetype):
+        insert_module_file(cursor, ident, filename, file, mimetype)
+
+    @db_connect
+    def get_html_fileids(self, cursor):
+        cursor.execute("SELECT module_ident, fileid FROM module_files "
+                       "WHERE filename = 'index.cnxml.html' "
+                       "ORDER BY module_ident")
+        return cursor.fetchall()
+
+    @db_connect
+    def get_cached_fileids(self, cursor):
+        cursor.execute("SELECT fileid FROM html_transform_cache")
+        return [row[0] for row in cursor.fetchall()]
+
+    def call_target(self, **kwargs):
+        from ..upgrades.to_html import produce_html_for_modules
+        kwargs.setdefault('use_cache', True)
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            return list(produce_html_for_modules(
+                db_connection,
+                'SELECT module_ident FROM modules ORDER BY module_ident',
+                source_filename='index.cnxml', **kwargs))
+
+    def test_hit(self):
+        self.setup_test_data([1, 2])
+
+        result = self.call_target()
+
+        self.assertEqual([ident for ident, message in result], [1, 2])
+        self.assertEqual(result[1], (2, None,))
+        self.assertEqual(self.transformed, [1])
+        (ident1, fileid1), (ident2, fileid2) = self.get_html_fileids()
+        self.assertEqual(fileid1, fileid2)
+
+    def test_miss_with_other_resources(self):
+        # The same source refers to the module's own resources.
+        self.setup_test_data([1, 2])
+        self.add_module_file(2, 'image.png', 'not an image', 'image/png')
+
+        result = self.call_target()
+
+        self.assertEqual([ident for ident, message in result], [1, 2])
+        self.assertEqual(self.transformed, [1, 2])
+        (ident1, fileid1), (ident2, fileid2) = self.get_html_fileids()
+        self.assertNotEqual(fileid1, fileid2)
+
+    def test_existing_html(self):
+        self.setup_test_data([1, 2, 3])
+        self.add_module_file(
+            2, 'index.cnxml.html',
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body/></html>',
+            'text/html')
+        html_fileid = self.get_html_fileids()[0][1]
+
+        result = self.call_target()
+
+        self.assertEqual([ident for ident, message in result], [1, 2, 3])
+        # The existing HTML is reported on and left alone, without
+        #   failing the modules after it.
+        self.assertNotEqual(result[1][1], None)
+        self.assertEqual(result[2], (3, None,))
+        self.assertEqual(self.transformed, [1, 2])
+        fileids = dict(self.get_html_fileids())
+        self.assertEqual(fileids[2], html_fileid)
+        self.assertEqual(fileids[1], fileids[3])
+
+
+    def test_overwrite_in_batches(self):
+        self.setup_test_data([1, 2])
+        self.call_target()
+        html_fileid = self.get_html_fileids()[0][1]
+        self.assertEqual(self.get_cached_fileids(), [html_fileid])
+
+        # Overwriting removes the cached HTML, and its cache entry.
+        result = self.call_target(use_cache=False, batch_size=2,
+                                  overwrite_html=True)
+
+        self.assertEqual([ident for ident, message in result], [1, 2])
+        (ident1, fileid1), (ident2, fileid2) = self.get_html_fileids()
+        self.assertNotEqual(fileid1, html_fileid)
+        self.assertNotEqual(fileid2, html_fileid)
+        self.assertEqual(self.get_cached_fileids(), [])
+
+
+class BatchTestCase(unittest.TestCase):
+    """Tests for produce_html_for_modules writing back in batches
+    """
+    fixture = postgresql_fixture
+
+    def setUp(self):
+        self.fixture.setUp()
+        path = os.path.join(TESTING_DATA_DIRECTORY, 'm10470-2.2.cnxml')
+        with open(path) as f:
+            self.cnxml = f.read()
+
+    def tearDown(self):
+        self.fixture.tearDown()
+
+    @db_connect
+    def setup_test_data(self, cursor, idents):
+        """Adds modules at ``idents`` with identical sources."""
+        for ident in idents:
+            insert_module(cursor, ident)
+            insert_module_file(cursor, ident, 'index.cnxml', self.cnxml,
+                               'text/xml')
+
+    @db_connect
+    def add_module_file(self, cursor, ident, filename, file, mimetype):
+        insert_module_file(cursor, ident, filename, file, mimetype)
+
+    @db_connect
+    def set_source(self, cursor, ident, file):
+        cursor.execute("UPDATE files SET file = %s "
+                       "WHERE fileid = (SELECT fileid FROM module_files "
+                       "                WHERE module_ident = %s "
+                       "                      AND filename = 'index.cnxml')",
+                       (memoryview(file), ident,))
+
+    @db_connect
+    def add_module(self, cursor, ident):
+        insert_module(cursor, ident)
+
+    @db_connect
+    def get_html(self, cursor):
+        cursor.execute("SELECT mf.module_ident, mf.fileid, mf.mimetype, "
+                       "       length(f.file) > 0 "
+                       "FROM module_files AS mf NATURAL JOIN files AS f "
+                       "WHERE mf.filename = 'index.cnxml.html' "
+                       "ORDER BY mf.module_ident")
+        return cursor.fetchall()
+
+    @db_connect
+    def file_exists(self, cursor, fileid):
+        cursor.execute("SELECT 1 FROM files WHERE fileid = %s", (fileid,))
+        return cursor.fetchone() is not None
+
+    def call_target(self, id_select_query='SELECT module_ident FROM modules '
+                                          'ORDER BY module_ident',
+                    **kwargs):
+        from ..upgrades.to_html import produce_html_for_modules
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            return list(produce_html_for_modules(
+                db_connection, id_select_query,
+                source_filename='index.cnxml', **kwargs))
+
+    def test_batches(self):
+        self.setup_test_data([1, 2, 3])
+        # Module 1 is done one at a time, to compare with.
+        expected = self.call_target('SELECT 1')
+
+        result = self.call_target('SELECT 2 UNION ALL SELECT 3',
+                                  batch_size=2)
+
+        self.assertEqual(result, [(2, expected[0][1],),
+                                  (3, expected[0][1],)])
+        html = self.get_html()
+        self.assertEqual([row[0] for row in html], [1, 2, 3])
+        self.assertEqual(len(set(row[1] for row in html)), 3)
+        self.assertEqual([row[2:] for row in html],
+                         [('text/html', True,)] * 3)
+
+    def test_messages(self):
+        self.setup_test_data([1, 2, 4])
+        self.add_module_file(
+            1, 'index.cnxml.html',
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body/></html>',
+            'text/html')
+        # Module 3 has no source, module 4's is not UTF-8.
+        self.add_module(3)
+        self.set_source(4, self.cnxml + '<!-- \xe9 -->')
+
+        result = self.call_target(batch_size=10)
+
+        self.assertEqual([ident for ident, message in result], [1, 2, 3, 4])
+        self.assertTrue('already exists' in result[0][1])
+        self.assertTrue('Missing source' in result[2][1])
+        self.assertTrue('UTF-8' in result[3][1])
+        # The failures do not fail the modules alongside them.
+        self.assertEqual([row[0] for row in self.get_html()], [1, 2])
+
+    def test_overwrite(self):
+        self.setup_test_data([1, 2])
+        self.call_target(batch_size=10)
+        fileids = [row[1] for row in self.get_html()]
+
+        result = self.call_target(batch_size=10)
+        self.assertTrue('already exists' in result[0][1])
+        self.assertEqual([row[1] for row in self.get_html()], fileids)
+
+        result = self.call_target(batch_size=10, overwrite_html=True)
+
+        self.assertEqual([ident for ident, message in result], [1, 2])
+        html = self.get_html()
+        self.assertEqual([row[0] for row in html], [1, 2])
+        for fileid, row in zip(fileids, html):
+            self.assertNotEqual(row[1], fileid)
+            self.assertFalse(self.file_exists(fileid))
+
+    def test_failed_batch(self):
+        self.setup_test_data([1, 2, 3])
+        # The first batch fails while writing back, which aborts
+        #   its transaction.
+        from ..upgrades import to_html
+        original = to_html.insert_module_files
+        self.addCleanup(setattr, to_html, 'insert_module_files', original)
+        calls = []
+        def f(cursor, *args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                cursor.execute("SELECT 1/0")
+            return original(cursor, *args, **kwargs)
+        to_html.insert_module_files = f
+
+        result = self.call_target(batch_size=2)
+
+        self.assertEqual([ident for ident, message in result], [1, 2, 3])
+        self.assertTrue('division by zero' in result[0][1])
+        self.assertTrue('division by zero' in result[1][1])
+        self.assertEqual([row[0] for row in self.get_html()], [3])
+
+
+class WorkersTestCase(unittest.TestCase):
+    """Tests for produce_html_for_modules with worker processes
+    """
+    fixture = postgresql_fixture
+
+    def setUp(self):
+        self.fixture.setUp()
+        self.setup_test_data()
+
+    def tearDown(self):
+        self.fixture.tearDown()
+
+    @db_connect
+    def setup_test_data(self, cursor):
+        path = os.path.join(TESTING_DATA_DIRECTORY, 'm10470-2.2.cnxml')
+        with open(path) as f:
+            cnxml = f.read()
+        for ident in range(1, 8):
+            insert_module(cursor, ident)
+            insert_module_file(cursor, ident, 'index.cnxml', cnxml,
+                               'text/xml')
+
+    @db_connect
+    def get_html_idents(self, cursor):
+        cursor.execute("SELECT module_ident FROM module_files "
+                       "WHERE filename = 'index.cnxml.html' "
+                       "ORDER BY module_ident")
+        return [row[0] for row in cursor.fetchall()]
+
+    def call_target(self, **kwargs):
+        from ..upgrades.to_html import produce_html_for_modules
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            return list(produce_html_for_modules(
+                db_connection,
+                'SELECT module_ident FROM modules ORDER BY module_ident',
+                source_filename='index.cnxml', workers=2,
+                connection_string=DB_CONNECTION_STRING,
+                itersize=2, **kwargs))
+
+    def test(self):
+        result = self.call_target()
+
+        self.assertEqual([ident for ident, message in result],
+                         range(1, 8))
+        self.assertEqual(self.get_html_idents(), range(1, 8))
+
+    def test_batches(self):
+        result = self.call_target(batch_size=3)
+
+        self.assertEqual([ident for ident, message in result],
+                         range(1, 8))
+        self.assertEqual(self.get_html_idents(), range(1, 8))
+
+
+class UniqueAbstractsTestCase(unittest.TestCase):
+    """Tests for produce_html_for_unique_abstracts
+    """
+    fixture = postgresql_fixture
+
+    def setUp(self):
+        self.fixture.setUp()
+        self.setup_test_data()
+
+        # Count the abstract transforms, failing the ones asked to.
+        from ..upgrades import to_html
+        original = to_html.transform_abstract
+        self.addCleanup(setattr, to_html, 'transform_abstract', original)
+        self.transformed = []
+        self.failing = []
+        def f(abstract, db_connection, document_ident=None):
+            self.transformed.append(document_ident)
+            if document_ident in self.failing:
+                raise ValueError('Failed transform')
+            return original(abstract, db_connection,
+                            document_ident=document_ident)
+        to_html.transform_abstract = f
+
+    def tearDown(self):
+        self.fixture.tearDown()
+
+    @db_connect
+    def setup_test_data(self, cursor):
+        # Modules 1 and 2 share an abstract, module 3 has its own.
+        cursor.execute("INSERT INTO abstracts (abstractid, abstract) "
+                       "VALUES (1, 'A shared abstract'), "
+                       "       (2, 'Another abstract')")
+        for ident, abstractid in ((1, 1), (2, 1), (3, 2)):
+            insert_module(cursor, ident, abstractid)
+
+    @db_connect
+    def get_abstracts_without_html(self, cursor):
+        cursor.execute("SELECT abstractid FROM abstracts "
+                       "WHERE html IS NULL ORDER BY abstractid")
+        return [row[0] for row in cursor.fetchall()]
+
+    def call_target(self, id_select_query, **kwargs):
+        from ..upgrades.to_html import (make_abstract_select_query,
+                                        produce_html_for_unique_abstracts)
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            return list(produce_html_for_unique_abstracts(
+                db_connection, make_abstract_select_query(id_select_query),
+                **kwargs))
+
+    def test_shared_abstract_transformed_once(self):
+        result = self.call_target('SELECT module_ident FROM modules;')
+
+        self.assertEqual([abstractid for abstractid, message in result],
+                         [1, 2])
+        self.assertEqual(self.transformed, [1, 3])
+        self.assertEqual(self.get_abstracts_without_html(), [])
+
+    def test_id_select_query(self):
+        result = self.call_target('SELECT 3')
+
+        self.assertEqual([abstractid for abstractid, message in result], [2])
+        self.assertEqual(self.transformed, [3])
+        self.assertEqual(self.get_abstracts_without_html(), [1])
+
+    def test_failed_transform(self):
+        self.failing = [1]
+
+        result = self.call_target('SELECT module_ident FROM modules;',
+                                  batch_size=1)
+
+        self.assertEqual(result[0], (1, 'Failed transform',))
+        self.assertEqual(result[1][0], 2)
+        self.assertEqual(self.get_abstracts_without_html(), [1])
+
+    def test_failed_batch(self):
+        # The first batch fails while writing back, which aborts
+        #   its transaction.
+        from ..upgrades import to_html
+        original = to_html.copy_binary
+        self.addCleanup(setattr, to_html, 'copy_binary', original)
+        calls = []
+        def f(cursor, *args, **kwargs):
+            calls.append(args)
+            if len(calls) == 1:
+                cursor.execute("SELECT 1/0")
+            return original(cursor, *args, **kwargs)
+        to_html.copy_binary = f
+
+        result = self.call_target('SELECT module_ident FROM modules;',
+                                  batch_size=1)
+
+        self.assertEqual([abstractid for abstractid, message in result],
+                         [1, 2])
+        self.assertTrue('division by zero' in result[0][1])
+        self.assertEqual(self.get_abstracts_without_html(), [1])
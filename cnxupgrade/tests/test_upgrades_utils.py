@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+
+"""Tests for cnxupgrade.upgrades.utils
+"""
+
+import unittest
+
+import psycopg2
+
+from . import DB_CONNECTION_STRING
+
+
+class StreamIdentsTestCase(unittest.TestCase):
+
+    def call_target(self, *args, **kwargs):
+        from ..upgrades.utils import stream_idents
+        return stream_idents(*args, **kwargs)
+
+    def test_streamed_in_batches(self):
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            idents = self.call_target(
+                db_connection, 'SELECT generate_series(1, 10);', itersize=3)
+            self.assertEqual(list(idents), range(1, 11))
+
+    def test_commit_while_streaming(self):
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            idents = self.call_target(
+                db_connection, 'SELECT generate_series(1, 5)', itersize=2)
+            result = []
+            for ident in idents:
+                result.append(ident)
+                db_connection.commit()
+            self.assertEqual(result, [1, 2, 3, 4, 5])
+
+
+class IterBatchesTestCase(unittest.TestCase):
+
+    def call_target(self, *args, **kwargs):
+        from ..upgrades.utils import iter_batches
+        return iter_batches(*args, **kwargs)
+
+    def test(self):
+        self.assertEqual(list(self.call_target(xrange(7), 3)),
+                         [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_empty(self):
+        self.assertEqual(list(self.call_target([], 3)), [])
+
+
+class CopyBinaryTestCase(unittest.TestCase):
+
+    def call_target(self, *args, **kwargs):
+        from ..upgrades.utils import copy_binary
+        return copy_binary(*args, **kwargs)
+
+    def test(self):
+        with psycopg2.connect(DB_CONNECTION_STRING) as db_connection:
+            with db_connection.cursor() as cursor:
+                cursor.execute("CREATE TEMP TABLE copy_target "
+                               "(id INTEGER, name TEXT, file BYTEA, flag BOOLEAN)")
+                self.call_target(cursor, 'copy_target',
+                                 ('id', 'name', 'file', 'flag',),
+                                 [(1, u'\xe9t\xe9', b'\x00\xff', True),
+                                  (2, None, b'', False)])
+                cursor.execute("SELECT id, name, file, flag FROM copy_target "
+                               "ORDER BY id")
+                rows = [(i, n, f is not None and f[:] or None, b)
+                        for i, n, f, b in cursor.fetchall()]
+            db_connection.rollback()
+        self.assertEqual(rows,
+                         [(1, '\xc3\xa9t\xc3\xa9', b'\x00\xff', True),
+                          (2, None, b'', False)])
@@ -31,6 +31,7 @@ UPGRADES = (
     'v1',
     'migrate_hit_counts',
     'cnxml7',
+    'cnxml_census',
     'create_collection_minor_versions',
     'remove_testdraft',
     'migrate_ga',
@@ -11,7 +11,10 @@ import csv
 
 import psycopg2
 
-from .main import main
+from ..utils import DEFAULT_ITERSIZE
+from .main import DEFAULT_BATCH_SIZE, main
+from .stats import RunStats
+from .utils import DTD_CATALOG_DIRECTORY, configure_dtd_catalog
 
 
 __all__ = ('cli_loader',)
@@ -21,17 +24,94 @@ def cli_command(**kwargs):
     """The command used by the CLI to invoke the upgrade logic."""
     connection_string = kwargs['db_conn_str']
     report = csv.writer(kwargs['report_file'])
+    itersize = kwargs.get('itersize', DEFAULT_ITERSIZE)
+    workers = kwargs.get('workers', 1)
+    batch_size = kwargs.get('batch_size', DEFAULT_BATCH_SIZE)
+    configure_dtd_catalog(kwargs.get('dtd_catalog'),
+                          kwargs.get('offline', False))
+    memory_limit = kwargs.get('memory_limit')
+    if memory_limit is not None:
+        memory_limit = memory_limit * 1024 * 1024
+    stats = None
+    if kwargs.get('timings', False) or kwargs.get('progress'):
+        stats = RunStats(slowest=kwargs.get('slowest', 10),
+                         progress_every=kwargs.get('progress'),
+                         progress_file=sys.stderr)
 
     with psycopg2.connect(connection_string) as db_connection:
-        for processed in main(db_connection):
+        results = main(db_connection, itersize=itersize, workers=workers,
+                       batch_size=batch_size,
+                       connection_string=connection_string, stats=stats,
+                       incremental=kwargs.get('incremental', False),
+                       time_limit=kwargs.get('time_limit'),
+                       memory_limit=memory_limit,
+                       retry_over_budget=kwargs.get('retry_over_budget',
+                                                    False),
+                       cnxml_versions=kwargs.get('cnxml_versions'))
+        for processed in results:
             ##mid, version, ident, xml_version, state, message = processed
             ##print("%7s @ %4s - %s (%s) - %s - %s" % processed)
+            if not kwargs.get('timings', False):
+                processed = processed[:6]
             report.writerow(processed)
 
+    if stats is not None:
+        for line in stats.summary():
+            sys.stderr.write(line + '\n')
+
 
 def cli_loader(parser):
     """Used to load the CLI toggles and switches."""
     parser.add_argument('--report-file', type=argparse.FileType('w'),
                         default=sys.stdout,
                         help="output file (defaults to stdout)")
+    parser.add_argument('--itersize', type=int, default=DEFAULT_ITERSIZE,
+                        help="number of modules fetched from the server "
+                             "at a time (defaults to {})"
+                             .format(DEFAULT_ITERSIZE))
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes used to upgrade "
+                             "documents (defaults to 1)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="number of upgraded documents inserted per "
+                             "commit (defaults to {})"
+                             .format(DEFAULT_BATCH_SIZE))
+    parser.add_argument('--dtd-catalog', default=None,
+                        help="directory mirroring the DTD urls "
+                             "(defaults to {})".format(DTD_CATALOG_DIRECTORY))
+    parser.add_argument('--offline', action='store_true', default=False,
+                        help="never fetch DTDs missing from the catalog "
+                             "over the network, fail instead")
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help="skip modules that were already upgraded "
+                             "and record the progress, so an interrupted "
+                             "run can be resumed")
+    parser.add_argument('--cnxml-version', action='append',
+                        dest='cnxml_versions', default=None,
+                        metavar='VERSION',
+                        help="only upgrade documents of this CNXML version, "
+                             "as recorded by the cnxml_census upgrade "
+                             "(may be given more than once)")
+    parser.add_argument('--time-limit', type=float, default=None,
+                        metavar='SECONDS',
+                        help="kill the upgrade of a document taking longer "
+                             "than this")
+    parser.add_argument('--memory-limit', type=int, default=None,
+                        metavar='MB',
+                        help="kill the upgrade of a document using more "
+                             "memory than this")
+    parser.add_argument('--retry-over-budget', action='store_true',
+                        default=False,
+                        help="upgrade the documents that went over the time "
+                             "or memory limit again, one at a time and "
+                             "without limits, at the end of the run")
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help="add per-stage timings and sizes to the report "
+                             "and print a summary to stderr")
+    parser.add_argument('--progress', type=int, default=None, metavar='N',
+                        help="print the throughput to stderr every "
+                             "N documents")
+    parser.add_argument('--slowest', type=int, default=10, metavar='N',
+                        help="number of slowest documents listed in the "
+                             "summary (defaults to 10)")
     return cli_command
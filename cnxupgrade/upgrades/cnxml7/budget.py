@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Run work in isolated processes within a time and memory budget."""
+import multiprocessing
+import resource
+import threading
+from multiprocessing.pool import ThreadPool
+
+
+__all__ = ('OVER_BUDGET', 'WorkerError', 'BudgetedWorker', 'BudgetedPool',)
+
+
+# The state of a document that could not be processed within the budget.
+OVER_BUDGET = 'over_budget'
+
+
+class WorkerError(Exception):
+    """Stands in for an exception raised by the target of a budgeted
+    worker, which was within the budget but failed all the same.
+    """
+
+
+def _serve(connection, target, memory_limit):
+    """Apply ``target`` to the items received over the ``connection``
+    and send back the results, until ``None`` is received.
+    """
+    if memory_limit is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard,))
+    while True:
+        item = connection.recv()
+        if item is None:
+            break
+        try:
+            result = target(item)
+        except MemoryError:
+            connection.send((False, 'memory limit of {} bytes exceeded'
+                                    .format(memory_limit),))
+        except Exception as exc:
+            # Only the message is sent back, the exception itself
+            #   may not survive pickling.
+            connection.send((True, WorkerError(exc.message or repr(exc)),))
+        else:
+            connection.send((True, result,))
+
+
+class BudgetedWorker:
+    """Applies ``target`` to an item in a process of its own, limited to
+    ``timeout`` seconds and ``memory_limit`` bytes of address space.
+    A process that runs out of time (or dies) is killed and replaced
+    by a new one on the next call.
+    """
+
+    def __init__(self, target, timeout=None, memory_limit=None):
+        self.target = target
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._process = None
+        self._connection = None
+
+    def _start(self):
+        self._connection, child_connection = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=_serve,
+            args=(child_connection, self.target, self.memory_limit,))
+        self._process.daemon = True
+        self._process.start()
+        child_connection.close()
+
+    def __call__(self, item):
+        """Returns a tuple of whether ``item`` was processed within the
+        budget and either the result or the reason it was not.
+        Should ``target`` raise, the result is a ``WorkerError``.
+        """
+        if self._process is None:
+            self._start()
+        self._connection.send(item)
+        if self._connection.poll(self.timeout):
+            try:
+                return self._connection.recv()
+            except EOFError:
+                reason = 'worker process exited'
+        else:
+            reason = 'time limit of {}s exceeded'.format(self.timeout)
+        self.close(kill=True)
+        return False, reason
+
+    def close(self, kill=False):
+        if self._process is None:
+            return
+        if kill:
+            self._process.terminate()
+        else:
+            self._connection.send(None)
+        self._process.join()
+        self._connection.close()
+        self._process = None
+        self._connection = None
+
+
+class BudgetedPool:
+    """A pool of ``processes`` budgeted workers (see ``BudgetedWorker``),
+    each driven by a thread of its own.
+    """
+
+    def __init__(self, target, processes, timeout=None, memory_limit=None):
+        self.target = target
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._threads = ThreadPool(processes)
+
+    def _call(self, item):
+        worker = getattr(self._local, 'worker', None)
+        if worker is None:
+            worker = BudgetedWorker(self.target, self.timeout,
+                                    self.memory_limit)
+            self._local.worker = worker
+            with self._lock:
+                self._workers.append(worker)
+        within_budget, result = worker(item)
+        return item, within_budget, result
+
+    def imap(self, items, chunksize=1):
+        """Yield a tuple of each item, whether it was processed within
+        the budget and either the result or the reason it was not,
+        in the order of ``items``.
+        """
+        return self._threads.imap(self._call, items, chunksize)
+
+    def close(self):
+        self._threads.close()
+        self._threads.join()
+        for worker in self._workers:
+            worker.close()
+
+    def terminate(self):
+        self._threads.terminate()
+        for worker in self._workers:
+            worker.close(kill=True)
+
+    def join(self):
+        self._threads.join()
@@ -5,98 +5,429 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
+import itertools
+import multiprocessing
+import time
+
 import psycopg2
 
-from .utils import determine_cnxml_version, normalize_xml
-from .transforms import upgrade_document
-
-
-__all__ = ('main',)
-
-
-SQL_BUTTER_FUNCTION = """\
-CREATE OR REPLACE FUNCTION butter (file BYTEA) RETURNS TEXT AS $$
-DECLARE
-  value TEXT;
-BEGIN
-  BEGIN
-    value := convert_from(file, 'utf-8');
-  EXCEPTION
-    WHEN character_not_in_repertoire THEN
-      -- try again...
-      BEGIN
-        value := convert_from(file, 'latin1');
-      EXCEPTION
-        WHEN character_not_in_repertoire THEN
-          value := "ENCODING ERROR";
-      END;
-  END;
-  RETURN value;
-END;
-$$ LANGUAGE plpgsql;
+from ..utils import (DEFAULT_ITERSIZE, copy_binary, insert_module_file,
+                     insert_module_files, stream_query)
+from .utils import decode_document, determine_cnxml_version, serialize_xml
+from .transforms import upgrade_document_tree, warm_up
+from .budget import OVER_BUDGET, BudgetedPool, WorkerError
+
+
+__all__ = ('main', 'process_document',)
+
+# Number of documents handed to a worker process at a time.
+WORKER_CHUNK_SIZE = 10
+# Number of documents handled per commit.
+DEFAULT_BATCH_SIZE = 100
+
+# Selects the modules along with their raw (undecoded) CNXML document.
+SQL_SELECT_DOCUMENTS = """\
+SELECT m.moduleid, m.version, m.module_ident, f.file
+FROM latest_modules AS m
+     JOIN module_files AS mf ON mf.module_ident = m.module_ident
+     JOIN files AS f ON f.fileid = mf.fileid
+WHERE m.portal_type = 'Module'
+      AND mf.filename = 'index.cnxml'
+ORDER BY m.module_ident ASC
+"""
+# Same as ``SQL_SELECT_DOCUMENTS``, less the modules that already have
+#   the generated file or were successfully processed from an identical
+#   source. Failed documents are selected again.
+SQL_SELECT_PENDING_DOCUMENTS = """\
+SELECT m.moduleid, m.version, m.module_ident, f.file
+FROM latest_modules AS m
+     JOIN module_files AS mf ON mf.module_ident = m.module_ident
+     JOIN files AS f ON f.fileid = mf.fileid
+WHERE m.portal_type = 'Module'
+      AND mf.filename = 'index.cnxml'
+      AND NOT EXISTS (SELECT 1 FROM module_files AS g
+                        WHERE g.module_ident = m.module_ident
+                              AND g.filename = %(filename)s)
+      AND NOT EXISTS (SELECT 1 FROM cnxml7_progress AS p
+                        WHERE p.module_ident = m.module_ident
+                              AND p.source_md5 = f.md5
+                              AND p.state)
+ORDER BY m.module_ident ASC
+"""
+# Narrows either of the above to the documents recorded with one of the
+#   given versions by the cnxml_census upgrade.
+SQL_CNXML_VERSION_FILTER = """\
+      AND EXISTS (SELECT 1 FROM cnxml_versions AS v
+                    WHERE v.module_ident = m.module_ident
+                          AND v.fileid = mf.fileid
+                          AND v.cnxml_version = ANY (%(cnxml_versions)s))
+"""
+# Same as ``SQL_SELECT_DOCUMENTS``, but only for the given module_idents.
+SQL_SELECT_DOCUMENTS_BY_IDENT = """\
+SELECT m.moduleid, m.version, m.module_ident, f.file
+FROM latest_modules AS m
+     JOIN module_files AS mf ON mf.module_ident = m.module_ident
+     JOIN files AS f ON f.fileid = mf.fileid
+WHERE m.portal_type = 'Module'
+      AND mf.filename = 'index.cnxml'
+      AND m.module_ident = ANY(%(idents)s)
+ORDER BY m.module_ident ASC
+"""
+# Records the outcome of each processed module along with the md5 of
+#   the source it was processed from.
+SQL_CREATE_PROGRESS = """\
+CREATE TABLE IF NOT EXISTS cnxml7_progress (
+  module_ident INTEGER PRIMARY KEY,
+  source_md5 TEXT,
+  cnxml_version TEXT,
+  state BOOLEAN,
+  message TEXT
+)
+"""
+SQL_SET_PROGRESS_SOURCE_MD5 = """\
+UPDATE cnxml7_progress AS p
+  SET source_md5 = f.md5
+  FROM module_files AS mf JOIN files AS f ON f.fileid = mf.fileid
+  WHERE mf.module_ident = p.module_ident
+        AND mf.filename = 'index.cnxml'
+        AND p.module_ident = ANY(%s)
 """
 
 
-def main(db_connection, filename='index_auto_generated.cnxml'):
-    """Upgrade CNXML documents to version 0.7 and normalize them into the
-    given filename, which will be entered into the database.
+def process_document(file, metrics=None):
+    """Upgrade and normalize a single CNXML document given as ``file``.
+    This does no database work, so it can be run in a worker process.
+    The time spent in each stage is recorded in the ``metrics`` dict,
+    when one is given.
+
+    Returns a tuple of the CNXML version, the state, a message and
+    the upgraded document (None when it could not be upgraded).
+    """
+    if metrics is None:
+        metrics = {}
+    # Can we determine the CNML version?
+    start = time.time()
+    try:
+        cnxml_version = determine_cnxml_version(file)
+    except:
+        # Probably a deeper problem with the document itself.
+        #   Fail and move on.
+        metrics['detect'] = time.time() - start
+        return '?', False, 'problem determining CNXML version', None
+    metrics['detect'] = time.time() - start
+
+    # Try to upgrade the document...
+    start = time.time()
+    doc, was_upgraded, error_messages = upgrade_document_tree(
+        file, version=cnxml_version)
+    metrics['xslt'] = time.time() - start
+    if not was_upgraded:
+        # Determine why... Errors are only sent out to stderr
+        return cnxml_version, False, error_messages, None
+    # The parsed tree has its entities expanded,
+    #   so it only needs to be serialized.
+    start = time.time()
+    file = serialize_xml(doc)
+    metrics['normalize'] = time.time() - start
+    metrics['output_bytes'] = len(file)
+    return cnxml_version, True, '', file
+
+
+def _read_documents(db_connection, itersize, query=SQL_SELECT_DOCUMENTS,
+                    params=None, withhold=True):
+    """Yield the module records along with their raw CNXML document
+    and the time it took to fetch them, streamed from the server.
+    """
+    records = stream_query(db_connection, query, params, itersize=itersize,
+                           withhold=withhold)
+    start = time.time()
+    for mid, version, ident, file in records:
+        # Buffers can not be pickled over to the workers.
+        file = file[:]
+        fetched = time.time() - start
+        yield mid, version, ident, file, fetched
+        start = time.time()
+
+
+def _read_documents_on_connection(connection_string, itersize,
+                                  query=SQL_SELECT_DOCUMENTS, params=None):
+    """Same as ``_read_documents``, but on a connection of its own.
+    The reading connection is never committed, so the documents are read
+    with a plain cursor, rather than one held (and so materialized on the
+    server) across the commits of the writing connection.
+    """
+    reader_connection = psycopg2.connect(connection_string)
+    try:
+        for record in _read_documents(reader_connection, itersize,
+                                      query, params, withhold=False):
+            yield record
+    finally:
+        reader_connection.close()
+
+
+def _process_record(record):
+    """Process the document of a record within a worker process.
+    Returns the processed record, the upgraded document and
+    the metrics of the document.
+    """
+    mid, version, ident, file, fetched = record
+    metrics = {'fetch': fetched, 'input_bytes': len(file)}
+    start = time.time()
+    file = decode_document(file)
+    metrics['decode'] = time.time() - start
+    cnxml_version, state, message, file = process_document(file, metrics)
+    processed = (mid, version, ident, cnxml_version, state, message,)
+    return processed, file, metrics
+
+
+def _record_progress(cursor, results):
+    """Record the outcome of the processed ``results`` in the
+    ``cnxml7_progress`` table, so a later incremental run skips them.
+    Documents that went over budget are left to be retried.
+    """
+    results = [processed for processed in results
+               if processed[4] != OVER_BUDGET]
+    if not results:
+        return
+    idents = [processed[2] for processed in results]
+    cursor.execute("DELETE FROM cnxml7_progress "
+                   "WHERE module_ident = ANY(%s)", (idents,))
+    copy_binary(cursor, 'cnxml7_progress',
+                ('module_ident', 'cnxml_version', 'state', 'message',),
+                [(ident, cnxml_version, state, message or None,)
+                 for mid, version, ident, cnxml_version, state, message
+                 in results])
+    cursor.execute(SQL_SET_PROGRESS_SOURCE_MD5, (idents,))
+
+
+def _within_budget(results):
+    """Unpack the results of a ``BudgetedPool``, turning the documents
+    that went over budget or failed into processed records of their own.
+    """
+    for record, within_budget, result in results:
+        if within_budget and not isinstance(result, WorkerError):
+            yield result
+            continue
+        mid, version, ident, file, fetched = record
+        if within_budget:
+            processed = (mid, version, ident, '?', False, result.message,)
+        else:
+            processed = (mid, version, ident, '?', OVER_BUDGET, result,)
+        yield processed, None, {'fetch': fetched, 'input_bytes': len(file)}
+
+
+def _write_batch(db_connection, batch, filename, incremental=False):
+    """Insert the upgraded documents of a batch of processed records
+    and commit them. Identical documents share a single file.
+    Returns the processed records.
+
+    The batch is inserted with set-based statements. Should that fail,
+    the documents are inserted one at a time, each in a savepoint of
+    its own, so a bad document only fails itself.
+
+    When ``incremental``, the outcome of the batch is recorded in the
+    same transaction (see ``_record_progress``).
     """
+    start = time.time()
+    rows = [(processed[2], file,) for processed, file, metrics in batch
+            if file is not None]
+    results = [processed for processed, file, metrics in batch]
     with db_connection.cursor() as cursor:
-        # Inject some encoding butter.
-        cursor.execute(SQL_BUTTER_FUNCTION)
-
-        # Grab cursory info about modules for iteration and logging.
-        cursor.execute("SELECT moduleid, version, module_ident "
-                       "FROM latest_modules "
-                       "     NATURAL LEFT JOIN module_files AS mf "
-                       "WHERE portal_type = 'Module' "
-                       "      AND mf.filename = 'index.cnxml' "
-                       "ORDER BY module_ident ASC;")
-        records = cursor.fetchall()
-
-        for record in records:
-            mid, version, ident = record
-            cursor.execute("SELECT butter(file) "
-                           "FROM module_files NATURAL LEFT JOIN files "
-                           "WHERE module_ident = %s "
-                           "      AND filename = 'index.cnxml';",
-                           (ident,))
-            file = cursor.fetchone()[0]
-
-            # Is it valid XML?
-            pass
-
-            # Can we determine the CNML version?
+        if rows:
+            cursor.execute("SAVEPOINT cnxml7_batch")
             try:
-                cnxml_version = determine_cnxml_version(file)
-            except:
-                # Probably a deeper problem with the document itself.
-                #   Fail and move on.
-                cnxml_version, state = '?', False
-                message = 'problem determining CNXML version'
+                insert_module_files(cursor, rows, filename, 'text/xml',
+                                    reuse_files=True)
+            except psycopg2.Error:
+                cursor.execute("ROLLBACK TO SAVEPOINT cnxml7_batch")
+                results = [_write_document(cursor, processed, file, filename)
+                           for processed, file, metrics in batch]
             else:
-                # Try to upgrade the document...
-                file, was_upgraded, error_messages = upgrade_document(file)
-                if was_upgraded or cnxml_version == '0.7':
-                    file = normalize_xml(file)
-                    cursor.execute("INSERT INTO files (file) VALUES (%s) "
-                                   "RETURNING fileid;",
-                                   (psycopg2.Binary(file),))
-                    fileid = cursor.fetchone()[0]
-                    cursor.execute("INSERT INTO module_files "
-                                   "(module_ident, fileid, filename, mimetype) "
-                                   "VALUES (%s, %s, 'index_auto_generated.cnxml', 'text/xml');",
-                                   (ident, fileid,))
-                    db_connection.commit()
-                    state, message = True, ''
-                else:
-                    # Determine why... Errors are only sent out to stderr
-                    state, message = False, error_messages
-
-            processed = (mid, version, ident, cnxml_version, state, message,)
+                cursor.execute("RELEASE SAVEPOINT cnxml7_batch")
+        if incremental and results:
+            _record_progress(cursor, results)
+    db_connection.commit()
+    # The inserts are shared by the documents of the batch.
+    inserted = rows and (time.time() - start) / len(rows) or 0.0
+    for processed, file, metrics in batch:
+        if file is not None:
+            metrics['insert'] = inserted
+    return results
+
+
+def _write_document(cursor, processed, file, filename):
+    """Insert the upgraded document of a processed record
+    within a savepoint. Returns the processed record.
+    """
+    if file is None:
+        return processed
+    cursor.execute("SAVEPOINT cnxml7_document")
+    try:
+        insert_module_file(cursor, processed[2], file, filename,
+                           'text/xml', reuse_files=True)
+    except psycopg2.Error as exc:
+        cursor.execute("ROLLBACK TO SAVEPOINT cnxml7_document")
+        return processed[:4] + (False, exc.message,)
+    cursor.execute("RELEASE SAVEPOINT cnxml7_document")
+    return processed
+
+
+def _write_batches(db_connection, results, filename, batch_size,
+                   stats=None, incremental=False):
+    """Write the processed ``results`` back ``batch_size`` at a time,
+    yielding the processed records once they have been committed.
+    When ``stats`` are given, the metrics of each document are added
+    to them and appended to the processed record.
+    """
+    batch = []
+    for result in results:
+        batch.append(result)
+        if len(batch) >= batch_size:
+            for processed in _report_batch(db_connection, batch, filename,
+                                           stats, incremental):
+                yield processed
+            batch = []
+    for processed in _report_batch(db_connection, batch, filename, stats,
+                                   incremental):
+        yield processed
+
+
+def _report_batch(db_connection, batch, filename, stats, incremental):
+    """Write a batch and yield its processed records (see ``_write_batches``).
+    """
+    results = _write_batch(db_connection, batch, filename, incremental)
+    for processed, (p, f, metrics) in zip(results, batch):
+        if stats is not None:
+            processed = processed + tuple(stats.add(processed[2], metrics))
+        yield processed
+
+
+def _main_in_parallel(db_connection, connection_string, query, params,
+                      filename, itersize, workers, batch_size, stats=None,
+                      incremental=False, budget=None):
+    """Read the documents selected by ``query``, upgrade them in a pool of
+    ``workers`` processes and write the results back ``batch_size``
+    at a time. Yields the processed records in module_ident order.
+
+    When a ``budget`` of ``(time_limit, memory_limit)`` is given,
+    each document is upgraded within that budget (see ``BudgetedPool``).
+    """
+    if budget is None:
+        pool = multiprocessing.Pool(processes=workers)
+    else:
+        time_limit, memory_limit = budget
+        pool = BudgetedPool(_process_record, workers, time_limit,
+                            memory_limit)
+    try:
+        records = _read_documents_on_connection(connection_string, itersize,
+                                                query, params)
+        if budget is None:
+            results = pool.imap(_process_record, records, WORKER_CHUNK_SIZE)
+        else:
+            results = _within_budget(pool.imap(records, WORKER_CHUNK_SIZE))
+        for processed in _write_batches(db_connection, results, filename,
+                                        batch_size, stats, incremental):
             yield processed
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _select_documents(filename, incremental, cnxml_versions=None):
+    """Returns the query and parameters selecting the documents to upgrade.
+    """
+    params = {}
+    if incremental:
+        query = SQL_SELECT_PENDING_DOCUMENTS
+        params['filename'] = filename
+    else:
+        query = SQL_SELECT_DOCUMENTS
+    if cnxml_versions:
+        query, order_by = query.rsplit('ORDER BY', 1)
+        query = query + SQL_CNXML_VERSION_FILTER + 'ORDER BY' + order_by
+        params['cnxml_versions'] = list(cnxml_versions)
+    return query, params or None
+
 
-        # Melt the butter.
-        cursor.execute("DROP FUNCTION butter(BYTEA);")
+def main(db_connection, filename='index_auto_generated.cnxml',
+         itersize=DEFAULT_ITERSIZE, workers=1, batch_size=DEFAULT_BATCH_SIZE,
+         connection_string=None, stats=None, incremental=False,
+         time_limit=None, memory_limit=None, retry_over_budget=False,
+         cnxml_versions=None):
+    """Upgrade CNXML documents to version 0.7 and normalize them into the
+    given filename, which will be entered into the database.
+    The module records are streamed from the server ``itersize`` at a time.
+    The upgraded documents are inserted and committed ``batch_size``
+    documents at a time. Documents identical to an existing file
+    reuse that file.
 
-        raise StopIteration
+    The documents are read on a separate connection (made using
+    ``connection_string``, defaults to the dsn of ``db_connection``),
+    so committing the upgraded documents does not hold the documents
+    still to be read on the server. When ``workers`` is greater than one,
+    the documents are upgraded by that many worker processes.
+
+    When ``stats`` (a ``RunStats``) are given, the stage timings and
+    sizes of each document are recorded in them and appended to the
+    processed records.
+
+    When ``incremental``, modules that already have the generated file,
+    or that were processed from an identical source by a previous
+    incremental run, are skipped. The outcome of each module is
+    committed along with its batch, so an interrupted run resumes
+    where it stopped.
+
+    When a ``time_limit`` (in seconds) or ``memory_limit`` (in bytes) is
+    given, each document is upgraded in an isolated process that is
+    killed once it goes over either limit. Those documents are reported
+    with the ``OVER_BUDGET`` state and are not recorded as processed.
+    With ``retry_over_budget``, they are upgraded again one at a time
+    without limits once all other documents are done.
+
+    When ``cnxml_versions`` are given, only the documents recorded with
+    one of those versions in the ``cnxml_versions`` table (see the
+    cnxml_census upgrade) are upgraded.
+    """
+    # Compile the stylesheets before any workers are forked.
+    warm_up()
+    if incremental:
+        with db_connection.cursor() as cursor:
+            cursor.execute(SQL_CREATE_PROGRESS)
+        db_connection.commit()
+    budget = None
+    if time_limit is not None or memory_limit is not None:
+        budget = (time_limit, memory_limit,)
+    if connection_string is None:
+        connection_string = db_connection.dsn
+    query, params = _select_documents(filename, incremental, cnxml_versions)
+    if workers > 1 or budget is not None:
+        results = _main_in_parallel(db_connection, connection_string,
+                                    query, params, filename, itersize,
+                                    workers, batch_size, stats, incremental,
+                                    budget)
+    else:
+        records = _read_documents_on_connection(connection_string, itersize,
+                                                query, params)
+        results = _write_batches(db_connection,
+                                 itertools.imap(_process_record, records),
+                                 filename, batch_size, stats, incremental)
+    over_budget = []
+    for processed in results:
+        if processed[4] == OVER_BUDGET:
+            over_budget.append(processed[2])
+        yield processed
+
+    if retry_over_budget and over_budget:
+        # Isolated still, so a document that can not be upgraded
+        #   at all only fails itself.
+        results = _main_in_parallel(db_connection, connection_string,
+                                    SQL_SELECT_DOCUMENTS_BY_IDENT,
+                                    {'idents': over_budget}, filename,
+                                    itersize, 1, batch_size, stats,
+                                    incremental, (None, None,))
+        for processed in results:
+            yield processed
+    raise StopIteration
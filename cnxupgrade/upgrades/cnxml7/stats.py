@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+import array
+import heapq
+import math
+import time
+
+
+__all__ = ('RunStats', 'STAGES',)
+
+
+# The stages a document goes through, in order.
+STAGES = ('fetch', 'decode', 'detect', 'xslt', 'normalize', 'insert',)
+SIZES = ('input_bytes', 'output_bytes',)
+PERCENTILES = (50, 95, 99,)
+
+
+def _percentile(sorted_values, percent):
+    """Nearest-rank percentile of the already sorted values."""
+    if not sorted_values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(rank, len(sorted_values) - 1))]
+
+
+class RunStats:
+    """Collects the per-document stage timings and sizes of a run.
+    The timings are kept in arrays, so a run over the whole archive
+    does not keep an object per document around.
+    """
+
+    def __init__(self, slowest=10, progress_every=None, progress_file=None):
+        self.slowest = slowest
+        self.progress_every = progress_every
+        self.progress_file = progress_file
+        self.count = 0
+        self.started = time.time()
+        self._timings = dict((stage, array.array('d'),) for stage in STAGES)
+        self._sizes = dict((size, 0,) for size in SIZES)
+        self._slowest = []
+
+    @property
+    def columns(self):
+        """The names of the columns returned by ``add``."""
+        return ['{}_seconds'.format(stage) for stage in STAGES] \
+            + list(SIZES)
+
+    def add(self, ident, metrics):
+        """Record the ``metrics`` of the document at ``ident`` and
+        return them as a list of report columns.
+        """
+        row = []
+        total = 0.0
+        for stage in STAGES:
+            seconds = metrics.get(stage, 0.0)
+            self._timings[stage].append(seconds)
+            total += seconds
+            row.append('{:.6f}'.format(seconds))
+        for size in SIZES:
+            value = metrics.get(size, 0)
+            self._sizes[size] += value
+            row.append(value)
+
+        entry = (total, ident,)
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, entry)
+        elif self.slowest:
+            heapq.heappushpop(self._slowest, entry)
+
+        self.count += 1
+        if self.progress_every and self.count % self.progress_every == 0:
+            self.progress_file.write(self.format_progress() + '\n')
+            self.progress_file.flush()
+        return row
+
+    @property
+    def rate(self):
+        """Documents per second since the run started."""
+        elapsed = time.time() - self.started
+        return elapsed and self.count / elapsed or 0.0
+
+    def format_progress(self):
+        return '{} documents, {:.2f} documents/sec' \
+               .format(self.count, self.rate)
+
+    def summary(self):
+        """Return the lines of the end-of-run summary."""
+        lines = [self.format_progress()]
+        header = ''.join(['{:>12}'.format('stage')]
+                         + ['{:>12}'.format('p{}'.format(p))
+                            for p in PERCENTILES]
+                         + ['{:>12}'.format('total')])
+        lines.append(header)
+        for stage in STAGES:
+            values = sorted(self._timings[stage])
+            lines.append(''.join(
+                ['{:>12}'.format(stage)]
+                + ['{:>12.4f}'.format(_percentile(values, p))
+                   for p in PERCENTILES]
+                + ['{:>12.2f}'.format(sum(values))]))
+        for size in SIZES:
+            lines.append('{}: {}'.format(size, self._sizes[size]))
+        if self._slowest:
+            lines.append('slowest module_idents:')
+            for total, ident in sorted(self._slowest, reverse=True):
+                lines.append('  {} {:.4f}s'.format(ident, total))
+        return lines
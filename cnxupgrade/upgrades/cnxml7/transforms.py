@@ -9,16 +9,18 @@ import os
 from io import BytesIO
 import re
 from lxml import etree
-from .utils import apply_xslt, cnxml_parser, determine_cnxml_version
+from .utils import (apply_xslt_tree, cnxml_parser, determine_cnxml_version,
+                    warm_xslt_cache)
 
 
-__all__ = ('upgrade_document',)
+__all__ = ('upgrade_document', 'upgrade_document_tree', 'warm_up',)
 
 
 here = os.path.abspath(os.path.dirname(__file__))
 resources = os.path.join(here, 'resources')
 UPGRADE_05_TO_06_XSL = os.path.join(resources, 'cnxml05to06.xsl')
 UPGRADE_06_TO_07_XSL = os.path.join(resources, 'cnxml06to07.xsl')
+STYLESHEETS = (UPGRADE_05_TO_06_XSL, UPGRADE_06_TO_07_XSL,)
 ##UPGRADE_05_TO_06_XSL = 'http://cnx.rice.edu/technology/cnxml/stylesheet/cnxml05to06.xsl'
 ##UPGRADE_06_TO_07_XSL = 'http://cnx.rice.edu/technology/cnxml/stylesheet/cnxml06to07.xsl'
 
@@ -46,6 +48,12 @@ def add_namespace(source):
                         source, count=1)
     return source
 
+def warm_up():
+    """Compile the upgrade stylesheets once, before any documents
+    are upgraded.
+    """
+    warm_xslt_cache(STYLESHEETS)
+
 def upgrade_document(source, version=None):
     """Turn older CNXML (0.5/0.6) into newer (0.7).
     Checks version to determine if upgrade is needed.
@@ -54,11 +62,29 @@ def upgrade_document(source, version=None):
     """
     if version is None:
         version = determine_cnxml_version(source)
-
-    stylesheets = []
     if version == '0.7':
         # Do nothing. 0.7 is the latest
         return source, True, ''
+    doc, was_upgraded, messages = upgrade_document_tree(source, version)
+    if doc is None:
+        return None, was_upgraded, messages
+    return str(doc), was_upgraded, messages
+
+def upgrade_document_tree(source, version=None):
+    """Same as ``upgrade_document``, but the new document is returned as
+    a parsed tree, so that it can be handed on without reparsing.
+    A 0.7 document is parsed, but otherwise left as is.
+    """
+    if version is None:
+        version = determine_cnxml_version(source)
+
+    stylesheets = []
+    if version == '0.7':
+        try:
+            doc = etree.parse(BytesIO(source), parser=cnxml_parser)
+        except etree.XMLSyntaxError as exc:
+            return None, False, exc.message
+        return doc, True, ''
     elif version == '0.6':
         stylesheets.append(UPGRADE_06_TO_07_XSL)
     else:
@@ -71,6 +97,6 @@ def upgrade_document(source, version=None):
     except etree.XMLSyntaxError as exc:
         return None, False, exc.message
     messages = BytesIO()
-    result = apply_xslt(doc, stylesheets, messages)
+    result = apply_xslt_tree(doc, stylesheets, messages)
     messages.seek(0)
     return result, True, messages.read()
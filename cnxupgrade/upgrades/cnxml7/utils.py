@@ -5,17 +5,27 @@
 # Public License version 3 (AGPLv3).
 # See LICENCE.txt for details.
 # ###
+import os
+import re
+import urlparse
 import xml.parsers.expat
 from io import BytesIO
 from lxml import etree
 
 
 __all__ = (
-    'apply_xslt', 'cnxml_parser',
-    'determine_cnxml_version', 'normalize_xml',
+    'MissingFromCatalog',
+    'apply_xslt', 'apply_xslt_tree', 'catalog_resolver', 'cnxml_parser',
+    'configure_dtd_catalog', 'decode_document', 'determine_cnxml_version',
+    'get_xslt', 'scan_cnxml_version',
+    'normalize_xml', 'serialize_xml', 'warm_xslt_cache',
     )
 
 
+here = os.path.abspath(os.path.dirname(__file__))
+DTD_CATALOG_DIRECTORY = os.path.join(here, 'resources', 'dtd')
+
+
 CHUNK_SIZE = 400
 
 
@@ -67,6 +77,56 @@ class VersionRecognizer:
         return self.version
 
 
+# Number of leading bytes that ``scan_cnxml_version`` looks at.
+SCAN_SIZE = 4096
+_DOCTYPE_PUBLIC_ID_PATTERN = re.compile(
+    r'<!DOCTYPE\s+document\s+PUBLIC\s+["\']([^"\']*)["\']')
+_DOCUMENT_TAG_PATTERN = re.compile(r'<document[\s>][^>]*>')
+_VERSION_ATTR_PATTERN = re.compile(
+    r'\scnxml-version\s*=\s*["\']([^"\']*)["\']')
+
+
+def scan_cnxml_version(data):
+    """Recognize the CNXML version of the document given as ``data`` by
+    scanning its leading bytes for the doctype public id and the
+    ``cnxml-version`` attribute of the document element.
+
+    Returns None when the scan is not conclusive, in which case
+    ``determine_cnxml_version`` should be used instead.
+    """
+    head = data[:SCAN_SIZE]
+    doctype_version = None
+    match = _DOCTYPE_PUBLIC_ID_PATTERN.search(head)
+    if match and match.group(1).find('CNXML') != -1:
+        # publicId like "-//CNX//DTD CNXML 0.5//EN"
+        try:
+            doctype_version = match.group(1).split('//')[2].split()[2]
+        except IndexError:
+            return None
+    attr_version = None
+    match = _DOCUMENT_TAG_PATTERN.search(head)
+    if match:
+        match = _VERSION_ATTR_PATTERN.search(match.group(0))
+        if match:
+            attr_version = match.group(1)
+    if doctype_version and attr_version and doctype_version != attr_version:
+        # Which one wins depends on where expat's chunks end.
+        return None
+    return attr_version or doctype_version
+
+
+def decode_document(data):
+    """Given the raw bytes of a stored document as ``data``, return it
+    as UTF-8 encoded bytes. Documents that are not valid UTF-8 are taken
+    to be latin1.
+    """
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        data = data.decode('latin1').encode('utf-8')
+    return data
+
+
 def determine_cnxml_version(source):
     """Given a CNXML document as ``source``,
     determine what version of CNXML is being used.
@@ -75,10 +135,82 @@ def determine_cnxml_version(source):
     return recognizer.get_version()
 
 
+class MissingFromCatalog(Exception):
+    """Raised by an ``offline`` ``CatalogResolver`` for a url that is not
+    in its catalog.
+    """
+
+    def __init__(self, url, directory):
+        self.url = url
+        self.directory = directory
+        super(MissingFromCatalog, self).__init__(
+            "'{}' is not in the DTD catalog at '{}'".format(url, directory))
+
+
+class CatalogResolver(etree.Resolver):
+    """Resolves DTDs and entity files from a local catalog directory that
+    mirrors their urls. For example,
+    ``http://cnx.rice.edu/cnxml/0.5/DTD/cnxml_plain.dtd`` is looked up as
+    ``<directory>/cnx.rice.edu/cnxml/0.5/DTD/cnxml_plain.dtd``.
+
+    Resolved files are kept in memory, so each is read once per process.
+    Urls missing from the catalog are fetched over the network, or when
+    ``offline``, raise a ``MissingFromCatalog`` error out of the parse.
+    """
+
+    def __init__(self, directory=DTD_CATALOG_DIRECTORY, offline=False):
+        self.directory = directory
+        self.offline = offline
+        self._cache = {}
+
+    def _get_path(self, url):
+        parsed_url = urlparse.urlparse(url)
+        if parsed_url.scheme not in ('http', 'https',):
+            return None
+        return os.path.join(self.directory, parsed_url.netloc,
+                            *parsed_url.path.split('/'))
+
+    def resolve(self, url, public_id, context):
+        try:
+            data = self._cache[url]
+        except KeyError:
+            path = self._get_path(url)
+            if path is None:
+                # A local file, let libxml2 read it.
+                return None
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+            elif self.offline:
+                raise MissingFromCatalog(url, self.directory)
+            else:
+                return None
+            self._cache[url] = data
+        # The url is kept as the base, so that relative references
+        #   within the DTD are resolved through the catalog as well.
+        return self.resolve_string(data, context, base_url=url)
+
+
+catalog_resolver = CatalogResolver()
+
+
+def configure_dtd_catalog(directory=None, offline=None):
+    """Point the DTD catalog at another ``directory`` and/or
+    switch it to ``offline`` resolution.
+    """
+    if directory is not None:
+        catalog_resolver.directory = directory
+        catalog_resolver._cache.clear()
+    if offline is not None:
+        catalog_resolver.offline = offline
+
+
 XML_PARSER_KWARGS = dict(load_dtd=True, resolve_entities=True,
                          no_network=False, attribute_defaults=False)
 cnxml_parser = etree.XMLParser(**XML_PARSER_KWARGS)
+cnxml_parser.resolvers.add(catalog_resolver)
 xml_parser = etree.XMLParser(**XML_PARSER_KWARGS)
+xml_parser.resolvers.add(catalog_resolver)
 
 
 def normalize_xml(xml):
@@ -89,24 +221,80 @@ def normalize_xml(xml):
     return normalized_xml
 
 
+def serialize_xml(doc):
+    """Given a parsed (and therefore entity expanded) document as ``doc``,
+    serialize it once to UTF-8 encoded bytes.
+    """
+    return etree.tostring(doc.getroot(), encoding='utf-8')
+
+
+# Compiled stylesheets by location, see ``get_xslt``.
+_xslt_cache = {}
+
+
+def _get_mtime(stylesheet):
+    try:
+        return os.path.getmtime(stylesheet)
+    except (OSError, TypeError,):
+        # Not a local file, e.g. a url.
+        return None
+
+
+def get_xslt(stylesheet):
+    """Return a tuple of the compiled ``XSLT`` for the ``stylesheet``
+    location and the messages logged while compiling it.
+    Compiled stylesheets are cached for the life of the process and
+    recompiled only when the stylesheet file has been modified.
+    """
+    mtime = _get_mtime(stylesheet)
+    try:
+        cached_mtime, xslt, compile_messages = _xslt_cache[stylesheet]
+    except KeyError:
+        pass
+    else:
+        if cached_mtime == mtime:
+            return xslt, compile_messages
+    ss_xml = etree.parse(stylesheet, parser=xml_parser)
+    xslt = etree.XSLT(ss_xml)
+    # Keep the compile log, because the error_log of the XSLT object
+    #   is replaced each time it is applied.
+    compile_messages = ["{}".format(entry) for entry in xslt.error_log]
+    _xslt_cache[stylesheet] = (mtime, xslt, compile_messages,)
+    return xslt, compile_messages
+
+
+def warm_xslt_cache(stylesheets):
+    """Compile the given ``stylesheets`` ahead of time, so that they are
+    shared by any worker processes forked afterwards.
+    """
+    for stylesheet in stylesheets:
+        get_xslt(stylesheet)
+
+
 def apply_xslt(xml, stylesheets, messages=None):
     """Apply a stylesheet (or list of stylesheets) given as ``stylesheets``
     to an XML document given as ``xml``. The stylesheets must be urls to
     XSLT files.
     """
+    return str(apply_xslt_tree(xml, stylesheets, messages))
+
+
+def apply_xslt_tree(xml, stylesheets, messages=None):
+    """Same as ``apply_xslt``, but the resulting document is returned
+    as a tree rather than serialized.
+    """
     if not isinstance(stylesheets, (list, set, tuple,)):
         stylesheets = [stylesheets]
 
     xml_in = xml
     xml_out = xml
     for stylesheet in stylesheets:
-        ss_xml = etree.parse(stylesheet, parser=xml_parser)
-        xslt = etree.XSLT(ss_xml)
-        if xslt.error_log and messages is not None:
-            for entry in xslt.error_log:
+        xslt, compile_messages = get_xslt(stylesheet)
+        if messages is not None:
+            for entry in compile_messages:
                 messages.write("{}\n".format(entry))
         xml_out = xslt(xml_in)
         # Pipeline input/output
         xml_in = xml_out
 
-    return str(xml_out)
+    return xml_out
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Records the CNXML version of every module's index.cnxml."""
+import collections
+
+import psycopg2
+
+from .cnxml7.utils import (SCAN_SIZE, decode_document,
+                           determine_cnxml_version, scan_cnxml_version)
+from .utils import DEFAULT_ITERSIZE, copy_binary, iter_batches, stream_query
+
+
+__all__ = ('cli_loader', 'take_census',)
+
+
+# Number of census results written per commit.
+DEFAULT_BATCH_SIZE = 1000
+
+SQL_CREATE_CENSUS_TABLE = """\
+CREATE TABLE IF NOT EXISTS cnxml_versions (
+  module_ident INTEGER PRIMARY KEY,
+  fileid INTEGER NOT NULL,
+  cnxml_version TEXT
+);
+"""
+# Only the head of each file is streamed, which is all the scan needs.
+SQL_SELECT_DOCUMENT_HEADS = """\
+SELECT mf.module_ident, mf.fileid, substring(f.file from 1 for {})
+FROM module_files AS mf
+     JOIN files AS f ON f.fileid = mf.fileid
+WHERE mf.filename = 'index.cnxml'
+      {{}}
+ORDER BY mf.module_ident
+""".format(SCAN_SIZE)
+SQL_NOT_COUNTED = """\
+AND NOT EXISTS (SELECT 1 FROM cnxml_versions
+                  WHERE module_ident = mf.module_ident
+                        AND fileid = mf.fileid)
+"""
+
+
+def _determine_version(cursor, fileid, head):
+    """Scan the head of the file for its version, falling back to
+    the expat based recognizer on the whole file.
+    """
+    cnxml_version = scan_cnxml_version(head)
+    if cnxml_version is None:
+        cursor.execute("SELECT file FROM files WHERE fileid = %s",
+                       (fileid,))
+        file = decode_document(cursor.fetchone()[0][:])
+        try:
+            cnxml_version = determine_cnxml_version(file)
+        except:
+            cnxml_version = None
+    return cnxml_version
+
+
+def take_census(db_connection, recount=False, itersize=DEFAULT_ITERSIZE,
+                batch_size=DEFAULT_BATCH_SIZE, connection_string=None):
+    """Determine the CNXML version of each module's ``index.cnxml`` and
+    record it in the ``cnxml_versions`` table, committing every
+    ``batch_size`` modules. Modules already counted (with the same file)
+    are skipped, unless ``recount`` is true.
+
+    The heads are read on a separate connection (made using
+    ``connection_string``, defaults to the dsn of ``db_connection``)
+    that is never committed, so the heads still to be read are not
+    materialized on the server by the commits.
+
+    Yields a ``(module_ident, cnxml_version)`` tuple per module.
+    """
+    with db_connection.cursor() as cursor:
+        cursor.execute(SQL_CREATE_CENSUS_TABLE)
+    db_connection.commit()
+    if connection_string is None:
+        connection_string = db_connection.dsn
+
+    query = SQL_SELECT_DOCUMENT_HEADS.format(
+        '' if recount else SQL_NOT_COUNTED)
+    reader_connection = psycopg2.connect(connection_string)
+    try:
+        rows = stream_query(reader_connection, query, itersize=itersize,
+                            withhold=False)
+        for batch in iter_batches(rows, batch_size):
+            results = []
+            with db_connection.cursor() as cursor:
+                for ident, fileid, head in batch:
+                    cnxml_version = _determine_version(cursor, fileid,
+                                                       head[:])
+                    results.append((ident, fileid, cnxml_version,))
+                cursor.execute("DELETE FROM cnxml_versions "
+                               "WHERE module_ident = ANY (%s)",
+                               ([ident for ident, fileid, v in results],))
+                copy_binary(cursor, 'cnxml_versions',
+                            ('module_ident', 'fileid', 'cnxml_version',),
+                            results)
+            db_connection.commit()
+            for ident, fileid, cnxml_version in results:
+                yield ident, cnxml_version
+    finally:
+        reader_connection.close()
+
+
+def cli_command(**kwargs):
+    """The command used by the CLI to invoke the upgrade logic."""
+    connection_string = kwargs['db_conn_str']
+    recount = kwargs.get('recount', False)
+    itersize = kwargs.get('itersize', DEFAULT_ITERSIZE)
+    batch_size = kwargs.get('batch_size', DEFAULT_BATCH_SIZE)
+
+    counts = collections.Counter()
+    with psycopg2.connect(connection_string) as db_connection:
+        for ident, cnxml_version in take_census(
+                db_connection, recount, itersize, batch_size,
+                connection_string=connection_string):
+            counts[cnxml_version] += 1
+    for cnxml_version, count in sorted(counts.items()):
+        print '{}: {}'.format(cnxml_version or 'unknown', count)
+
+
+def cli_loader(parser):
+    """Used to load the CLI toggles and switches."""
+    parser.add_argument('--recount', action='store_true', default=False,
+                        help='recount modules that are already counted')
+    parser.add_argument('--itersize', type=int, default=DEFAULT_ITERSIZE,
+                        help='number of documents fetched from the server '
+                             'at a time, default {}'.format(DEFAULT_ITERSIZE))
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='number of results written per commit, '
+                             'default {}'.format(DEFAULT_BATCH_SIZE))
+    return cli_command
@@ -6,12 +6,23 @@
 # See LICENCE.txt for details.
 # ###
 
+import argparse
+import array
+import bisect
 import datetime
+import json
+import multiprocessing
+import multiprocessing.util
+import time
 
 import psycopg2
+from psycopg2.extensions import PYDATETIMETZ
+from psycopg2.tz import FixedOffsetTimezone
 
 from cnxarchive.database import (get_collection_tree, next_version,
-        republish_collection, rebuild_collection_tree, get_minor_version)
+        republish_collection, get_minor_version)
+
+from .utils import DEFAULT_ITERSIZE, copy_binary, stream_idents, stream_query
 
 __all__ = ('cli_loader',)
 
@@ -21,6 +32,197 @@ WHERE portal_type='Collection' AND minor_version=1
 ORDER BY revised
 '''
 
+# Selects the revisions of the given modules of a collection tree that
+# were published between the collection version and the next one,
+# in the order they were published.
+SQL_SELECT_TREE_REVISIONS = '''\
+SELECT tree.module_ident, m.module_ident, m.revised
+FROM modules AS tree JOIN modules AS m ON m.uuid = tree.uuid
+WHERE tree.module_ident = ANY(%s)
+      AND m.revised > %s AND m.revised < %s
+      AND m.revised > tree.revised
+ORDER BY m.revised, m.module_ident
+'''
+SQL_SELECT_MODULE_REVISIONS = '''\
+SELECT uuid, revised, module_ident FROM modules
+WHERE portal_type = 'Module'
+ORDER BY uuid, revised, module_ident
+'''
+SQL_SELECT_TREE_MODULES = '''\
+SELECT module_ident, uuid, revised FROM modules
+WHERE module_ident = ANY(%s)
+'''
+# Claims a collection for the current transaction, using an advisory
+# lock keyed on its uuid, so no two processes work on it at once.
+# The key is 64 bits of the md5 of the uuid, as two int4 keys.
+SQL_TRY_LOCK_COLLECTION = '''\
+SELECT pg_try_advisory_xact_lock(('x' || substr(key, 1, 8))::bit(32)::int4,
+                                 ('x' || substr(key, 9, 8))::bit(32)::int4)
+FROM (SELECT md5(uuid::text) AS key FROM modules
+      WHERE module_ident = %s) AS m
+'''
+# Counts the rows of a collection tree, as copied by rebuild_collection_tree.
+SQL_COUNT_TREE_ROWS = '''\
+WITH RECURSIVE t(node, path) AS (
+    SELECT tr.nodeid, ARRAY[tr.nodeid] FROM trees tr WHERE tr.documentid = %s
+UNION ALL
+    SELECT c.nodeid, path || ARRAY[c.nodeid]
+    FROM trees c JOIN t ON c.parent_id = t.node
+    WHERE NOT c.nodeid = ANY(t.path)
+)
+SELECT count(*) FROM t
+'''
+# Selects the rows of a collection tree, as rebuild_collection_tree does.
+SQL_SELECT_TREE_ROWS = '''\
+WITH RECURSIVE t(node, parent, document, title, childorder, latest, path) AS (
+    SELECT tr.*, ARRAY[tr.nodeid] FROM trees tr WHERE tr.documentid = %s
+UNION ALL
+    SELECT c.*, path || ARRAY[c.nodeid]
+    FROM trees c JOIN t ON c.parent_id = t.node
+    WHERE NOT c.nodeid = ANY(t.path)
+)
+SELECT node, parent, document, title, childorder, latest FROM t
+'''
+SQL_CREATE_TREE_STAGING = '''\
+CREATE TEMP TABLE IF NOT EXISTS collection_tree_staging (
+  ordinal INTEGER,
+  nodeid INTEGER,
+  parent_id INTEGER,
+  documentid INTEGER,
+  title TEXT,
+  childorder INTEGER,
+  latest BOOLEAN
+);
+CREATE TEMP TABLE IF NOT EXISTS document_id_map_staging (
+  batch INTEGER,
+  old_ident INTEGER,
+  new_ident INTEGER
+);
+TRUNCATE collection_tree_staging, document_id_map_staging;
+'''
+# Copies the staged tree with new nodeids (assigned in the order
+# rebuild_collection_tree would), the root pointing at the new collection
+# and the documents replaced as of the given batch.
+SQL_INSERT_STAGED_TREE = '''\
+WITH new_nodes AS (
+  SELECT o.nodeid AS old_nodeid, nextval('nodeid_seq') AS nodeid
+  FROM (SELECT nodeid FROM collection_tree_staging ORDER BY ordinal) AS o
+)
+INSERT INTO trees (nodeid, parent_id, documentid, title, childorder, latest)
+  SELECT n.nodeid, p.nodeid,
+         CASE WHEN t.parent_id IS NULL THEN %(collection_ident)s
+              ELSE coalesce(m.new_ident, t.documentid) END,
+         t.title, t.childorder, t.latest
+  FROM collection_tree_staging AS t
+       JOIN new_nodes AS n ON n.old_nodeid = t.nodeid
+       LEFT JOIN new_nodes AS p ON p.old_nodeid = t.parent_id
+       LEFT JOIN document_id_map_staging AS m
+         ON m.batch = %(batch)s AND m.old_ident = t.documentid
+  ORDER BY t.ordinal
+'''
+
+# Records the collections whose minor versions have been created,
+# so a restarted run skips them.
+SQL_CREATE_COMPLETED_COLLECTIONS = '''\
+CREATE TABLE IF NOT EXISTS collection_minor_versions_completed (
+  module_ident INTEGER PRIMARY KEY,
+  completed TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+)
+'''
+SQL_RECORD_COMPLETED_COLLECTION = '''\
+INSERT INTO collection_minor_versions_completed (module_ident) VALUES (%s)
+'''
+SQL_SELECT_COMPLETED_COLLECTION = '''\
+SELECT 1 FROM collection_minor_versions_completed WHERE module_ident = %s
+'''
+
+# The outcomes of claiming a collection, see ``_claim_collection``.
+CLAIMED = 'claimed'
+CLAIMED_ELSEWHERE = 'claimed elsewhere'
+ALREADY_COMPLETED = 'already completed'
+
+DEFAULT_COMMIT_EVERY = 10
+
+# The database connection and options used by a worker process,
+#   see ``_init_worker``.
+_worker_connection = None
+_worker_options = None
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=FixedOffsetTimezone(offset=0))
+
+
+def _to_microseconds(revised):
+    delta = revised - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+class RevisionIndex:
+    """The revisions of every module, by uuid, in revised order.
+
+    The revised timestamps (as microseconds since the epoch, which
+    doubles hold exactly) and module_idents of all the revisions are
+    kept in two flat arrays, sorted by uuid and revised. Each uuid maps
+    to its slice of the arrays, which is searched by bisection.
+    """
+
+    def __init__(self):
+        self._revised = array.array('d')
+        self._module_idents = array.array('i')
+        self._slices = {}
+
+    @classmethod
+    def load(cls, db_connection, itersize=DEFAULT_ITERSIZE):
+        """Build the index with a single streamed scan of modules."""
+        index = cls()
+        start = 0
+        last_uuid = None
+        for uuid, revised, module_ident in stream_query(
+                db_connection, SQL_SELECT_MODULE_REVISIONS,
+                itersize=itersize):
+            if uuid != last_uuid:
+                if last_uuid is not None:
+                    index._slices[last_uuid] = (start,
+                                                len(index._revised))
+                start = len(index._revised)
+                last_uuid = uuid
+            index._revised.append(_to_microseconds(revised))
+            index._module_idents.append(module_ident)
+        if last_uuid is not None:
+            index._slices[last_uuid] = (start, len(index._revised))
+        return index
+
+    def __len__(self):
+        return len(self._revised)
+
+    def revisions(self, uuid, after, before):
+        """Returns the module_idents and revised timestamps of the
+        revisions of ``uuid`` published after ``after`` and before
+        ``before``, in revised order.
+        """
+        start, end = self._slices.get(uuid, (0, 0,))
+        lo = bisect.bisect_right(self._revised, _to_microseconds(after),
+                                 start, end)
+        hi = bisect.bisect_left(self._revised, _to_microseconds(before),
+                                lo, end)
+        return [(self._module_idents[i],
+                 EPOCH + datetime.timedelta(microseconds=self._revised[i]))
+                for i in xrange(lo, hi)]
+
+    def tree_revisions(self, cursor, tree_module_idents, after, before):
+        """Same as the ``SQL_SELECT_TREE_REVISIONS`` query, but answered
+        from the index.
+        """
+        cursor.execute(SQL_SELECT_TREE_MODULES, [tree_module_idents])
+        results = []
+        for tree_module_ident, uuid, revised in cursor.fetchall():
+            for module_ident, module_revised in self.revisions(
+                    uuid, max(after, revised), before):
+                results.append((tree_module_ident, module_ident,
+                                module_revised))
+        results.sort(key=lambda result: (result[2], result[1],))
+        return results
+
+
 def fix_document_id_map(document_id_map):
     # Sometimes we end up with a document_id_map that looks like this:
     # {1: 5, 2: 3, 3: 4}
@@ -30,18 +232,43 @@ def fix_document_id_map(document_id_map):
     # But really we just want document 2 to be replaced by 4 directly
     # so we need to turn it into {1: 5, 2: 4}
     # so we know we're replacing document 2 with document 4, not 3
-    for old_ident, new_ident in document_id_map.iteritems():
-        if new_ident in document_id_map:
-            document_id_map[old_ident] = document_id_map.pop(new_ident)
-            break
-    else:
-        # went through the loop and nothing needs to be changed
-        return
-    fix_document_id_map(document_id_map)
+    #
+    # Each chain is followed once from its start (a document that does not
+    # replace anything in the map), remembering where the documents along
+    # the way end up, so chains sharing a tail are not followed again.
+    replacements = set(document_id_map.itervalues())
+    resolved = {}
+    for old_ident in [ident for ident in document_id_map
+                      if ident not in replacements]:
+        chain = []
+        seen = set([old_ident])
+        new_ident = document_id_map[old_ident]
+        while new_ident in document_id_map and new_ident not in seen:
+            if new_ident in resolved:
+                new_ident = resolved[new_ident]
+                break
+            chain.append(new_ident)
+            seen.add(new_ident)
+            new_ident = document_id_map[new_ident]
+        for ident in chain:
+            resolved[ident] = new_ident
+        document_id_map[old_ident] = new_ident
+    for ident in resolved:
+        del document_id_map[ident]
 
-def create_collection_minor_versions(cursor, collection_ident):
-    """Migration to create collection minor versions from the existing modules
-    and collections """
+def plan_collection_minor_versions(cursor, collection_ident,
+                                   revision_index=None):
+    """Work out the collection minor versions to create from the existing
+    modules and collections, without changing anything. The module
+    revisions are looked up in the ``revision_index`` (a ``RevisionIndex``)
+    when one is given.
+
+    Returns the plan, a dict of the ``collection_ident`` and its
+    ``batches``, each with the ``minor_version`` and ``revised`` of the
+    collection version to publish, the ``module_idents`` it brings in
+    and the ``replacements`` to make in the tree. Returns None when
+    there is nothing to do.
+    """
     if get_minor_version(collection_ident, cursor) is None:
         # Not a collection so do nothing
         return
@@ -81,48 +308,45 @@ def create_collection_minor_versions(cursor, collection_ident):
         # so nothing to do
         return
 
-    # gather all relevant module versions
-    sql = '''SELECT DISTINCT(m.module_ident), m.revised FROM modules m
-    WHERE m.revised > %s AND m.revised < %s AND
-        m.uuid = (SELECT uuid FROM modules WHERE module_ident = %s) AND
-        m.revised > (SELECT revised FROM modules WHERE module_ident = %s)
-    ORDER BY m.revised
-    '''
+    tree_module_idents = [module_ident for module_ident, portal_type
+                          in get_collection_tree(collection_ident, cursor)
+                          if portal_type == 'Module']
 
+    # get all the modules with the same uuid as a module in the tree that
+    # have been published between this collection version and the next
+    # version, for the whole tree at once and already sorted by revised
+    if revision_index is None:
+        cursor.execute(SQL_SELECT_TREE_REVISIONS,
+                       [tree_module_idents, this_revised, next_revised])
+        revisions = cursor.fetchall()
+    else:
+        revisions = revision_index.tree_revisions(
+            cursor, tree_module_idents, this_revised, next_revised)
+
+    # about what the loop below does...
+    #
+    # e.g. we have a module m1, and it was updated 3 times between the
+    # time the collection is updated
+    #
+    # let's say the module_ident for current m1 is 1 and the updated
+    # versions 3, 6, 9
+    #
+    # then the results for m1 look like
+    # [(1, 3, revised), (1, 6, revised), (1, 9, revised)]
+    #
+    # we need to know that 3 replaces 1, 6 replaces 3 and 9 replaces 6
+    # so that we know what to change when we copy the collection tree
+    #
+    # so old_module_idents should have:
+    # {3: 1, 6: 3, 9: 6}
     old_module_idents = {}
+    latest_module_idents = {}
     modules = []
-    for module_ident, portal_type in get_collection_tree(collection_ident,
-            cursor):
-        if portal_type == 'Module':
-            cursor.execute(sql, [this_revised, next_revised, module_ident, module_ident])
-
-            # get all the modules with the same uuid that have been published
-            # between this collection version and the next version
-            results = cursor.fetchall()
-
-            # about what the loop below does...
-            #
-            # e.g. we have a module m1, and it was updated 3 times between the
-            # time the collection is updated
-            #
-            # let's say the module_ident for current m1 is 1 and the updated
-            # versions 3, 6, 9
-            #
-            # then results looks like [(3, revised), (6, revised), (9, revised)
-            #
-            # we need to know that 3 replaces 1, 6 replaces 3 and 9 replaces 6
-            # so that we know what to change when we copy the collection tree
-            #
-            # so old_module_idents should have:
-            # {3: 1, 6: 3, 9: 6}
-            for i, data in enumerate(results):
-                if i == 0:
-                    old_module_idents[data[0]] = module_ident
-                else:
-                    old_module_idents[data[0]] = results[i - 1][0]
-                modules.append(data)
-
-    modules.sort(lambda a, b: cmp(a[1], b[1])) # sort modules by revised
+    for tree_module_ident, module_ident, module_revised in revisions:
+        old_module_idents[module_ident] = latest_module_idents.get(
+            tree_module_ident, tree_module_ident)
+        latest_module_idents[tree_module_ident] = module_ident
+        modules.append((module_ident, module_revised))
 
     # batch process modules that are revised within 24 hours of each other
     batched_modules = []
@@ -136,41 +360,348 @@ def create_collection_minor_versions(cursor, collection_ident):
             batched_modules[-1].append((module_ident, module_revised))
 
     next_minor_version = next_version(collection_ident, cursor)
+    batches = []
     for modules in batched_modules:
-        # revised should be the revised of the latest module
-        module_revised = modules[-1][1]
-        new_ident = republish_collection(next_minor_version, collection_ident,
-                                         cursor, revised=module_revised)
-
-        document_id_map = {collection_ident: new_ident}
-        module_idents = [m[0] for m in modules]
+        document_id_map = {}
         for module_ident, module_revised in modules:
             document_id_map[old_module_idents[module_ident]] = module_ident
         fix_document_id_map(document_id_map)
 
-        rebuild_collection_tree(collection_ident, document_id_map, cursor)
-
+        batches.append({
+            'minor_version': next_minor_version,
+            # revised should be the revised of the latest module
+            'revised': modules[-1][1],
+            'module_idents': [m[0] for m in modules],
+            'replacements': sorted(document_id_map.items()),
+            })
         next_minor_version += 1
+    return {'collection_ident': collection_ident, 'batches': batches}
+
+
+def _fetch_tree(cursor, collection_ident):
+    """Returns the rows of the collection tree in the order
+    rebuild_collection_tree copies them (depth first).
+    """
+    cursor.execute(SQL_SELECT_TREE_ROWS, [collection_ident])
+    children = {}
+    for row in cursor.fetchall():
+        children.setdefault(row[1], []).append(row)
+    tree = []
+    stack = children.get(None, [])[:1]
+    while stack:
+        row = stack.pop()
+        tree.append(row)
+        stack.extend(reversed(children.get(row[0], [])))
+    return tree
+
+
+def apply_collection_minor_versions_plan(cursor, plan):
+    """Create the collection minor versions of a plan made by
+    ``plan_collection_minor_versions``.
+
+    The collection tree is fetched once and staged, along with the
+    documents each batch replaces in it, so every new tree is built with
+    a single ``INSERT ... SELECT`` rather than re-read and copied a row
+    at a time.
+    """
+    if not plan['batches']:
+        return
+    collection_ident = plan['collection_ident']
+    tree = _fetch_tree(cursor, collection_ident)
+    cursor.execute(SQL_CREATE_TREE_STAGING)
+    copy_binary(cursor, 'collection_tree_staging',
+                ('ordinal', 'nodeid', 'parent_id', 'documentid', 'title',
+                 'childorder', 'latest',),
+                [(i,) + tuple(row) for i, row in enumerate(tree)])
+
+    # Follow the documents of the tree through the batches, mapping
+    #   each to the document replacing it as of each batch.
+    current = dict((row[2], row[2],) for row in tree
+                   if row[1] is not None and row[2] is not None)
+    original = dict(current)
+    document_id_map = []
+    for i, batch in enumerate(plan['batches']):
+        for old_ident, new_ident in batch['replacements']:
+            ident = original.pop(old_ident, None)
+            if ident is not None:
+                current[ident] = new_ident
+                original[new_ident] = ident
+        document_id_map.extend((i, ident, new_ident,)
+                               for ident, new_ident in current.iteritems()
+                               if ident != new_ident)
+    copy_binary(cursor, 'document_id_map_staging',
+                ('batch', 'old_ident', 'new_ident',), document_id_map)
+
+    for i, batch in enumerate(plan['batches']):
+        new_ident = republish_collection(batch['minor_version'],
+                                         collection_ident, cursor,
+                                         revised=batch['revised'])
+        cursor.execute(SQL_INSERT_STAGED_TREE,
+                       {'batch': i, 'collection_ident': new_ident})
         collection_ident = new_ident
 
+
+def create_collection_minor_versions(cursor, collection_ident,
+                                     revision_index=None):
+    """Migration to create collection minor versions from the existing modules
+    and collections (see ``plan_collection_minor_versions``). """
+    plan = plan_collection_minor_versions(cursor, collection_ident,
+                                          revision_index=revision_index)
+    if plan is not None:
+        apply_collection_minor_versions_plan(cursor, plan)
+
+
+def estimate_plan_rows(cursor, plan):
+    """Returns the number of rows applying the ``plan`` would insert
+    into ``modules`` and ``trees``.
+    """
+    cursor.execute(SQL_COUNT_TREE_ROWS, [plan['collection_ident']])
+    tree_rows = cursor.fetchone()[0]
+    return {'modules': len(plan['batches']),
+            'trees': len(plan['batches']) * tree_rows}
+
+
+def dump_plan(plan):
+    """Serialize a plan into a line of JSON."""
+    def default(value):
+        if isinstance(value, datetime.datetime):
+            return value.isoformat(' ')
+        raise TypeError(repr(value))
+    return json.dumps(plan, default=default, sort_keys=True)
+
+
+def load_plan(line, cursor):
+    """Deserialize a plan serialized by ``dump_plan``."""
+    plan = json.loads(line)
+    for batch in plan['batches']:
+        batch['revised'] = PYDATETIMETZ(batch['revised'], cursor)
+    return plan
+
+def _claim_collection(cursor, collection_ident):
+    """Claim the collection for the current transaction.
+
+    Returns ``CLAIMED``, or ``CLAIMED_ELSEWHERE`` when another process
+    is working on it, or ``ALREADY_COMPLETED`` when it has been completed
+    (by another process) since the run started.
+    """
+    cursor.execute(SQL_TRY_LOCK_COLLECTION, [collection_ident])
+    row = cursor.fetchone()
+    # Without a module or uuid there is nothing to key the claim on,
+    #   the collection is left to fail on its own.
+    if row is not None and row[0] is not None and not row[0]:
+        return CLAIMED_ELSEWHERE
+    cursor.execute(SQL_SELECT_COMPLETED_COLLECTION, [collection_ident])
+    if cursor.fetchone() is not None:
+        return ALREADY_COMPLETED
+    return CLAIMED
+
+
+def _init_worker(connection_string, options):
+    """Initialize a worker process with its own database connection."""
+    global _worker_connection, _worker_options
+    _worker_connection = psycopg2.connect(connection_string)
+    # Close the connection when the worker process exits.
+    multiprocessing.util.Finalize(None, _worker_connection.close,
+                                  exitpriority=10)
+    _worker_options = options
+
+
+def _create_collection_minor_versions_in_worker(collection_ident):
+    """Create the minor versions of a collection within a worker process,
+    if the collection can be claimed. Each collection is committed
+    individually, which also releases the claim.
+
+    Returns the collection ident, the outcome of the claim (see
+    ``_claim_collection``) and an error message (if any).
+    """
+    db_connection = _worker_connection
+    with db_connection.cursor() as cursor:
+        try:
+            claim = _claim_collection(cursor, collection_ident)
+            if claim == CLAIMED:
+                create_collection_minor_versions(cursor, collection_ident,
+                                                 **_worker_options)
+                cursor.execute(SQL_RECORD_COMPLETED_COLLECTION,
+                               [collection_ident])
+        except Exception as exc:
+            db_connection.rollback()
+            return collection_ident, CLAIMED, exc.message
+        db_connection.commit()
+    return collection_ident, claim, None
+
+
+def _create_collection_minor_versions_in_parallel(connection_string, idents,
+                                                  workers, options):
+    """Distribute the collection idents over a pool of ``workers``
+    processes. Yields the results of
+    ``_create_collection_minor_versions_in_worker`` in the same order
+    as the given ``idents``.
+    """
+    # The workers are forked, so the options (e.g. the revision index)
+    #   are shared with them rather than copied over.
+    pool = multiprocessing.Pool(processes=workers,
+                                initializer=_init_worker,
+                                initargs=(connection_string, options,))
+    try:
+        for result in pool.imap(_create_collection_minor_versions_in_worker,
+                                idents):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _completed_collections(db_connection):
+    """Returns the set of collection idents recorded as completed."""
+    with db_connection.cursor() as cursor:
+        cursor.execute(SQL_CREATE_COMPLETED_COLLECTIONS)
+        cursor.execute('SELECT module_ident '
+                       'FROM collection_minor_versions_completed')
+        completed = set(row[0] for row in cursor.fetchall())
+    db_connection.commit()
+    return completed
+
+
 def cli_command(**kwargs):
     """The command used by the CLI to invoke the upgrade logic.
     """
     db_conn = kwargs['db_conn_str']
     id_select_query = kwargs['id_select_query']
+    itersize = kwargs.get('itersize', DEFAULT_ITERSIZE)
+    workers = kwargs.get('workers', 1)
+    commit_every = kwargs.get('commit_every', DEFAULT_COMMIT_EVERY)
+    commit_interval = kwargs.get('commit_interval')
     with psycopg2.connect(db_conn) as db_connection:
-        with db_connection.cursor() as cursor:
-
-            cursor.execute(id_select_query)
-            cols = cursor.fetchall()
-            print 'Number of collections: {}'.format(len(cols))
-            for i, col in enumerate(cols):
-                module_ident = col[0]
-                print 'Processing #{}, collection ident {}'.format(i, module_ident)
-                create_collection_minor_versions(cursor, module_ident)
-                if i % 10:
-                    db_connection.commit()
-        db_connection.commit()
+        completed = _completed_collections(db_connection)
+        if completed:
+            print 'Skipping {} completed collections'.format(len(completed))
+        options = {}
+        if kwargs.get('revision_index', False):
+            revision_index = RevisionIndex.load(db_connection,
+                                                itersize=itersize)
+            print 'Number of module revisions: {}'.format(len(revision_index))
+            options['revision_index'] = revision_index
+        if kwargs.get('plan'):
+            _write_plans(db_connection, kwargs['plan'], id_select_query,
+                         itersize, completed, options)
+            return
+        if kwargs.get('apply_plan'):
+            _apply_plans(db_connection, kwargs['apply_plan'], completed,
+                         commit_every, commit_interval)
+            return
+        if workers > 1:
+            idents = (ident for ident in stream_idents(db_connection,
+                                                       id_select_query,
+                                                       itersize=itersize)
+                      if ident not in completed)
+            results = _create_collection_minor_versions_in_parallel(
+                db_conn, idents, workers, options)
+            i = -1
+            for i, (module_ident, claim, message) in enumerate(results):
+                if claim == CLAIMED_ELSEWHERE:
+                    print 'Skipped #{}, collection ident {} is claimed by ' \
+                          'another process'.format(i, module_ident)
+                elif claim == ALREADY_COMPLETED:
+                    print 'Skipped #{}, collection ident {} is already ' \
+                          'completed'.format(i, module_ident)
+                elif message:
+                    print 'Failed #{}, collection ident {}: {}'.format(
+                        i, module_ident, message)
+                else:
+                    print 'Processed #{}, collection ident {}'.format(
+                        i, module_ident)
+            print 'Number of collections: {}'.format(i + 1)
+            return
+        idents = (ident for ident in stream_idents(db_connection,
+                                                   id_select_query,
+                                                   itersize=itersize)
+                  if ident not in completed)
+        tasks = ((ident, lambda cursor, ident=ident:
+                  create_collection_minor_versions(cursor, ident, **options))
+                 for ident in idents)
+        _run_serially(db_connection, tasks, commit_every, commit_interval)
+
+
+def _run_serially(db_connection, tasks, commit_every, commit_interval):
+    """Run the ``(collection_ident, task)`` tasks one at a time, each
+    in a savepoint of its own, recording the collections as completed
+    and committing every ``commit_every`` collections or
+    ``commit_interval`` seconds. Each collection is claimed first, as in
+    the workers, the claims are held until the next commit.
+    """
+    with db_connection.cursor() as cursor:
+        uncommitted = 0
+        last_commit = time.time()
+        i = -1
+        for i, (module_ident, task) in enumerate(tasks):
+            print 'Processing #{}, collection ident {}'.format(i, module_ident)
+            # A failing collection only rolls back its own changes.
+            cursor.execute('SAVEPOINT collection')
+            try:
+                claim = _claim_collection(cursor, module_ident)
+                if claim == CLAIMED:
+                    task(cursor)
+                    cursor.execute(SQL_RECORD_COMPLETED_COLLECTION,
+                                   [module_ident])
+            except Exception as exc:
+                cursor.execute('ROLLBACK TO SAVEPOINT collection')
+                print 'Failed #{}, collection ident {}: {}'.format(
+                    i, module_ident, exc.message)
+            else:
+                cursor.execute('RELEASE SAVEPOINT collection')
+                if claim == CLAIMED_ELSEWHERE:
+                    print 'Skipped #{}, collection ident {} is claimed by ' \
+                          'another process'.format(i, module_ident)
+                elif claim == ALREADY_COMPLETED:
+                    print 'Skipped #{}, collection ident {} is already ' \
+                          'completed'.format(i, module_ident)
+            uncommitted += 1
+            if uncommitted >= commit_every or (
+                    commit_interval is not None
+                    and time.time() - last_commit >= commit_interval):
+                db_connection.commit()
+                uncommitted = 0
+                last_commit = time.time()
+        print 'Number of collections: {}'.format(i + 1)
+    db_connection.commit()
+
+
+def _write_plans(db_connection, plan_file, id_select_query, itersize,
+                 completed, options):
+    """Write a line of JSON to ``plan_file`` for each collection that
+    would get minor versions, without changing anything.
+    """
+    idents = stream_idents(db_connection, id_select_query, itersize=itersize)
+    with db_connection.cursor() as cursor:
+        i = -1
+        for i, module_ident in enumerate(idents):
+            if module_ident in completed:
+                continue
+            plan = plan_collection_minor_versions(cursor, module_ident,
+                                                  **options)
+            if plan is None or not plan['batches']:
+                continue
+            plan['estimated_rows'] = estimate_plan_rows(cursor, plan)
+            plan_file.write(dump_plan(plan) + '\n')
+            plan_file.flush()
+        print 'Number of collections: {}'.format(i + 1)
+    db_connection.rollback()
+
+
+def _apply_plans(db_connection, plan_file, completed, commit_every,
+                 commit_interval):
+    """Apply the plans written by ``_write_plans`` to ``plan_file``."""
+    with db_connection.cursor() as cursor:
+        plans = (load_plan(line, cursor) for line in plan_file
+                 if line.strip())
+        tasks = ((plan['collection_ident'], lambda cursor, plan=plan:
+                  apply_collection_minor_versions_plan(cursor, plan))
+                 for plan in plans
+                 if plan['collection_ident'] not in completed)
+        _run_serially(db_connection, tasks, commit_every, commit_interval)
 
 def cli_loader(parser):
     """Used to load the CLI toggles and switches.
@@ -179,4 +710,32 @@ def cli_loader(parser):
                         help='an SQL query that returns module_idents to '
                              'create collection minor versions for, '
                              'default {}'.format(DEFAULT_ID_SELECT_QUERY))
+    parser.add_argument('--itersize', type=int, default=DEFAULT_ITERSIZE,
+                        help='number of idents fetched from the server at '
+                             'a time, default {}'.format(DEFAULT_ITERSIZE))
+    parser.add_argument('--commit-every', type=int,
+                        default=DEFAULT_COMMIT_EVERY,
+                        help='number of collections per commit, '
+                             'default {}'.format(DEFAULT_COMMIT_EVERY))
+    parser.add_argument('--commit-interval', type=float, default=None,
+                        help='also commit once this many seconds have '
+                             'passed since the last commit')
+    parser.add_argument('--plan', type=argparse.FileType('w'), default=None,
+                        metavar='FILE',
+                        help='write the minor versions each collection would '
+                             'get to FILE, as lines of JSON, without '
+                             'changing anything')
+    parser.add_argument('--apply-plan', type=argparse.FileType('r'),
+                        default=None, metavar='FILE',
+                        help='create the minor versions written to FILE by '
+                             '--plan, without looking for them again')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes creating minor versions, '
+                             'default 1; each collection is claimed with an '
+                             'advisory lock on its uuid, also with one')
+    parser.add_argument('--revision-index', action='store_true',
+                        default=False,
+                        help='load the revisions of all the modules into '
+                             'memory once, instead of querying them for '
+                             'each collection')
     return cli_command
@@ -6,6 +6,8 @@
 # See LICENCE.txt for details.
 # ###
 
+import errno
+import os
 import sys
 import psycopg2
 from psycopg2.extras import DictCursor
@@ -13,14 +15,181 @@ from psycopg2.extras import DictCursor
 from cnxarchive.database import (get_collection_tree, next_version,
         republish_collection, rebuild_collection_tree, get_minor_version)
 
+from .utils import DEFAULT_ITERSIZE, copy_binary, iter_batches, stream_idents
+
 __all__ = ('cli_loader',)
 
 DEFAULT_ID_SELECT_QUERY = '''\
 SELECT module_ident FROM modules
 WHERE now() - revised < '1 day'::interval 
-ORDER BY revised
+ORDER BY module_ident
+'''
+# Selects the modules added since the last dump, see ``read_watermark``:
+# the ones after the watermark and the ones missing below it last time.
+SQL_SELECT_IDENTS_SINCE_WATERMARK = '''\
+SELECT module_ident FROM modules
+WHERE module_ident > %s OR module_ident = ANY(%s::integer[])
+ORDER BY module_ident
+'''
+# The bounds of the transactions the dump can not see, the ones with
+# ids from xmin on were (or may have been) in progress.
+SQL_SELECT_SNAPSHOT = '''\
+SELECT txid_snapshot_xmin(s), txid_snapshot_xmax(s)
+FROM txid_current_snapshot() AS s
+'''
+# The given idents and the ones in the given range that have no module,
+# e.g. ones taken by transactions that were in progress.
+SQL_SELECT_MISSING_IDENTS = '''\
+SELECT i FROM unnest(%s::integer[] || ARRAY(SELECT generate_series(%s, %s))) AS i
+WHERE NOT EXISTS (SELECT 1 FROM modules WHERE module_ident = i)
+ORDER BY i
+'''
+
+# The idents of the modules being dumped.
+SQL_CREATE_DUMP_IDENTS = '''\
+CREATE TEMP TABLE IF NOT EXISTS dump_idents (module_ident INTEGER);
+TRUNCATE dump_idents;
 '''
 
+# Indexes for the anti-joins below to probe, created on request only
+# (see create_dump_indexes). modulekeywords already has one on keywordid,
+# the archive schema has none for the other two, without them the file
+# and abstract probes scan.
+DUMP_INDEXES = (
+    ('module_files_fileid_idx',
+     'CREATE INDEX CONCURRENTLY module_files_fileid_idx '
+     'ON module_files (fileid, module_ident)'),
+    ('modules_abstractid_idx',
+     'CREATE INDEX CONCURRENTLY modules_abstractid_idx '
+     'ON modules (abstractid, module_ident)'),
+    )
+# Whether an index exists and whether it is valid, an interrupted
+# concurrent build leaves an invalid one behind.
+SQL_SELECT_INDEX = '''\
+SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid
+WHERE c.relname = %s AND c.relkind = 'i'
+'''
+
+# The abstracts, keywords and files used by the dumped modules that no
+# earlier module uses, i.e. the ones the target does not have yet.
+# Each is probed for in the modules before the first dumped module that
+# uses it, with one anti-join for all the dumped modules.
+SQL_DUMP_NEW_ABSTRACTS = '''\
+WITH used AS (
+    SELECT m.abstractid, min(m.module_ident) AS module_ident
+    FROM modules m JOIN dump_idents d ON d.module_ident = m.module_ident
+    GROUP BY m.abstractid
+)
+SELECT a.abstractid, a.abstract FROM abstracts a
+     JOIN used ON used.abstractid = a.abstractid
+WHERE NOT EXISTS (SELECT 1 FROM modules old
+                  WHERE old.abstractid = used.abstractid
+                        AND old.module_ident < used.module_ident)
+ORDER BY a.abstractid'''
+SQL_DUMP_NEW_KEYWORDS = '''\
+WITH used AS (
+    SELECT mk.keywordid, min(mk.module_ident) AS module_ident
+    FROM modulekeywords mk JOIN dump_idents d ON d.module_ident = mk.module_ident
+    GROUP BY mk.keywordid
+)
+SELECT k.keywordid, k.word FROM keywords k
+     JOIN used ON used.keywordid = k.keywordid
+WHERE NOT EXISTS (SELECT 1 FROM modulekeywords old
+                  WHERE old.keywordid = used.keywordid
+                        AND old.module_ident < used.module_ident)
+ORDER BY k.keywordid'''
+SQL_DUMP_NEW_FILES = '''\
+WITH used AS (
+    SELECT mf.fileid, min(mf.module_ident) AS module_ident
+    FROM module_files mf JOIN dump_idents d ON d.module_ident = mf.module_ident
+    GROUP BY mf.fileid
+)
+SELECT f.fileid, f.md5, f.file FROM files f
+     JOIN used ON used.fileid = f.fileid
+WHERE NOT EXISTS (SELECT 1 FROM module_files old
+                  WHERE old.fileid = used.fileid
+                        AND old.module_ident < used.module_ident)
+ORDER BY f.fileid'''
+
+# The staging table each query is copied into, in load order.
+DUMP_COPIES = (
+    ('new_abstracts', SQL_DUMP_NEW_ABSTRACTS),
+    ('new_keywords', SQL_DUMP_NEW_KEYWORDS),
+    ('new_files', SQL_DUMP_NEW_FILES),
+    ('new_modules', '''select module_ident, moduleid, version, name, created, revised, abstractid,
+                        licenseid, doctype, submitter, submitlog, stateid, parent, language, authors,
+                        maintainers, licensors, parentauthors, portal_type
+                       from modules where module_ident in (select module_ident from dump_idents)
+                       order by module_ident'''),
+    ('new_module_files', '''select module_ident,fileid,filename,mimetype from module_files
+                            where module_ident in (select module_ident from dump_idents)
+                            order by module_ident'''),
+    ('new_modulefti', '''select module_ident,module_idx from modulefti
+                         where module_ident in (select module_ident from dump_idents)
+                         order by module_ident'''),
+    ('new_modulekeywords', '''select module_ident,keywordid from modulekeywords
+                              where module_ident in (select module_ident from dump_idents)
+                              order by module_ident'''),
+    ('new_moduletags', '''select module_ident,tagid from moduletags
+                          where module_ident in (select module_ident from dump_idents)
+                          order by module_ident'''),
+    )
+
+def read_watermark(state_file):
+    """Returns the highest module_ident dumped so far, the idents below it
+       that were missing at the time and the transaction id horizon they
+       were missing at, as recorded in the state_file, or None when
+       nothing has been recorded yet.
+
+       module_idents are taken when a module is inserted, but become
+       visible in the order their transactions commit. An ident below
+       the watermark that was missing may have belonged to a transaction
+       still in progress, so it is looked for again by the next dump."""
+    try:
+        with open(state_file) as f:
+            lines = f.read().splitlines()
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return None
+    watermark = int(lines[0])
+    horizon = len(lines) > 1 and lines[1] and int(lines[1]) or None
+    gaps = len(lines) > 2 and [int(i) for i in lines[2].split()] or []
+    return watermark, gaps, horizon
+
+def write_watermark(state_file, watermark, gaps=(), horizon=None):
+    """durably records the highest module_ident dumped, the idents missing
+       below it and the horizon in the state_file (see read_watermark),
+       replacing it atomically so an interrupted write leaves the old one"""
+    tmp_file = '{}.tmp'.format(state_file)
+    with open(tmp_file, 'w') as f:
+        f.write('{}\n'.format(watermark))
+        f.write('{}\n'.format('' if horizon is None else horizon))
+        f.write('{}\n'.format(' '.join(str(i) for i in gaps)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_file, state_file)
+
+def create_dump_indexes(db_conn):
+    """creates the indexes in DUMP_INDEXES that do not exist yet, each
+       concurrently so writes to the archive are not blocked while it is
+       built, which needs a connection of its own outside a transaction"""
+    db_connection = psycopg2.connect(db_conn)
+    try:
+        db_connection.autocommit = True
+        with db_connection.cursor() as cursor:
+            for name, statement in DUMP_INDEXES:
+                cursor.execute(SQL_SELECT_INDEX, (name,))
+                row = cursor.fetchone()
+                if row is not None and row[0]:
+                    continue
+                if row is not None:
+                    cursor.execute('DROP INDEX CONCURRENTLY {}'.format(name))
+                sys.stderr.write('Creating index {}\n'.format(name))
+                cursor.execute(statement)
+    finally:
+        db_connection.close()
+
 def create_temp_load_tables(f):
         f.write('create temp table new_abstracts (abstractid int, abstract text);\n')
         f.write('create temp table new_keywords (keywordid int, word text);\n')
@@ -62,81 +231,119 @@ def copy_load_tables(f):
         f.write('insert into modulekeywords (module_ident,keywordid ) select * from new_modulekeywords;\n')
         f.write('insert into moduletags (module_ident,tagid ) select * from new_moduletags;\n')
 
-def dump_module(cursor,module_ident, f):
+def truncate_load_tables(f):
+        f.write('truncate new_abstracts, new_keywords, new_files, new_modules, '
+                'new_module_files, new_modulefti, new_modulekeywords, '
+                'new_moduletags;\n')
+
+def in_ident_order(module_idents):
+    """yields the given module_idents once each, raising a ValueError
+       should they not be in ascending order"""
+    last = None
+    for module_ident in module_idents:
+        if module_ident == last:
+            continue
+        if last is not None and module_ident < last:
+            raise ValueError('module_ident {} follows {}, the idents must be '
+                             'ordered by module_ident'
+                             .format(module_ident, last))
+        last = module_ident
+        yield module_ident
+
+def dump_modules(cursor, module_idents, f):
+    """dumps SQL commands to transfer the given module_idents and all their
+       required child tables, with one COPY block per table"""
+    cursor.execute(SQL_CREATE_DUMP_IDENTS)
+    copy_binary(cursor, 'dump_idents', ('module_ident',),
+                [(module_ident,) for module_ident in module_idents])
+    cursor.execute('analyze dump_idents')
+    for table, query in DUMP_COPIES:
+        f.write('copy {} from stdin;\n'.format(table))
+        cursor.copy_expert('copy ({}) to stdout'.format(query), f)
+        f.write('\.\n')
+
+def dump_module(cursor, module_ident, f):
     """walks the tables dumping SQL commands to transfer given module_ident and all its
        required child tables"""
-    cursor.execute('select abstractid from modules where module_ident = %s', (module_ident,))
-    res = cursor.fetchone()
-    # Abstract
-    abid = res[0]
-    cursor.execute('select 1 from modules where abstractid = %s and module_ident < %s', (abid, module_ident))
-    res = cursor.fetchone()
-    if not(res):
-        f.write('copy new_abstracts from stdin;\n')
-        cursor.copy_expert('copy (select abstractid,abstract from abstracts where abstractid = %s) to stdout' % abid, f)
-        f.write('\.\n')
-    # Keywords
-    cursor.execute('select keywordid from modulekeywords where module_ident = %s', (module_ident,))
-    keyids = [k[0] for k in cursor.fetchall()]
-    cursor.execute('select keywordid from modulekeywords where module_ident < %s', (module_ident,))
-    old_keyids = [k[0] for k in cursor.fetchall()]
-    new_keyids = [k for k in keyids if k not in old_keyids]
-    if new_keyids:
-        f.write('copy new_keywords from stdin;\n')
-        cursor.copy_expert('copy (select keywordid,word from keywords  where keywordid in (%s)) to stdout' % str(new_keyids)[1:-1], f)
-        f.write('\.\n')
-    # Files
-    cursor.execute('select fileid from module_files where module_ident = %s', (module_ident,))
-    fileids = [i[0] for i in cursor.fetchall()]
-    cursor.execute('select fileid from module_files where module_ident < %s', (module_ident,))
-    old_fileids = [i[0] for i in cursor.fetchall()]
-    new_fileids = [i for i in fileids if i not in old_fileids]
-    new_fileids = {}.fromkeys(new_fileids).keys()
-    if new_fileids:
-        f.write('copy new_files from stdin;\n')
-        cursor.copy_expert('copy (select fileid,md5,file from files  where fileid in (%s)) to stdout' % str(new_fileids)[1:-1], f)
-        f.write('\.\n')
-    
-    f.write('copy new_modules from stdin;\n')
-    cursor.copy_expert('''copy (select module_ident, moduleid, version, name, created, revised, abstractid,
-                        licenseid, doctype, submitter, submitlog, stateid, parent, language, authors,
-                        maintainers, licensors, parentauthors, portal_type from modules  where module_ident = %s) to stdout''' % module_ident, f)
-    f.write('\.\n')
-    f.write('copy new_module_files from stdin;\n')
-    cursor.copy_expert('copy (select module_ident,fileid,filename,mimetype from module_files  where module_ident = %s) to stdout' % module_ident, f)
-    f.write('\.\n')
-    f.write('copy new_modulefti from stdin;\n')
-    cursor.copy_expert('copy (select module_ident,module_idx from modulefti  where module_ident = %s) to stdout' % module_ident, f)
-    f.write('\.\n')
-    f.write('copy new_modulekeywords from stdin;\n')
-    cursor.copy_expert('copy (select module_ident,keywordid from modulekeywords  where module_ident = %s) to stdout' % module_ident, f)
-    f.write('\.\n')
-    f.write('copy new_moduletags from stdin;\n')
-    cursor.copy_expert('copy (select module_ident,tagid from moduletags  where module_ident = %s) to stdout' % module_ident, f)
-    f.write('\.\n')
-    
+    dump_modules(cursor, [module_ident], f)
+
 def cli_command(**kwargs):
     """The command used by the CLI to invoke the upgrade logic.
     """
     db_conn = kwargs['db_conn_str']
     id_select_query = kwargs['id_select_query']
     filename = kwargs['filename']
+    itersize = kwargs.get('itersize', DEFAULT_ITERSIZE)
+    chunk_size = kwargs.get('chunk_size')
+    state_file = kwargs.get('state_file')
+    create_indexes = kwargs.get('create_indexes', False)
+    params = None
+    state = None
+    if state_file:
+        state = read_watermark(state_file)
+    watermark, gaps, horizon = state or (None, [], None)
+    if state is not None:
+        # dump exactly what was added since the last dump
+        sys.stderr.write('Dumping documents after ident {}\n'.format(watermark))
+        id_select_query = SQL_SELECT_IDENTS_SINCE_WATERMARK
+        params = (watermark, gaps,)
     if filename:
         f = open(filename,'w')
     else:
         f = sys.stdout
+    if create_indexes:
+        create_dump_indexes(db_conn)
     with psycopg2.connect(db_conn, cursor_factory=DictCursor) as db_connection:
+        # the whole dump sees one snapshot, so the idents missing from it
+        # are the ones taken by transactions it could not see
+        db_connection.set_session(isolation_level='REPEATABLE READ')
         with db_connection.cursor() as cursor:
-            cursor.execute(id_select_query)
-            docs = cursor.fetchall()
-            if docs:
-                create_temp_load_tables(f)
-                sys.stderr.write('Number of documents: {}\n'.format(len(docs)))
-                for i, doc in enumerate(docs):
-                    module_ident = doc[0]
-                    sys.stderr.write('Processing #{}, document ident {}\n'.format(i, module_ident))
-                    dump_module(cursor,module_ident,f)
+            cursor.execute(SQL_SELECT_SNAPSHOT)
+            snapshot_xmin, snapshot_xmax = cursor.fetchone()
+            idents = stream_idents(db_connection, id_select_query,
+                                   itersize=itersize, params=params)
+            if chunk_size:
+                # chunks are loaded in module_ident order, so whatever a
+                # chunk finds already transferred is loaded by an earlier
+                # chunk
+                chunks = iter_batches(in_ident_order(idents), chunk_size)
+            else:
+                # the one chunk is dumped in module_ident order regardless
+                chunks = [sorted(set(idents))]
+            count = 0
+            first = None
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if count == 0:
+                    create_temp_load_tables(f)
+                    first = chunk[0]
+                else:
+                    truncate_load_tables(f)
+                sys.stderr.write('Processing #{}-#{}, document idents {}-{}\n'.format(
+                    count, count + len(chunk) - 1, chunk[0], chunk[-1]))
+                dump_modules(cursor, chunk, f)
                 copy_load_tables(f)
+                count += len(chunk)
+                watermark = max(watermark, chunk[-1])
+            sys.stderr.write('Number of documents: {}\n'.format(count))
+            if state_file and watermark is not None:
+                if horizon is None or snapshot_xmin >= horizon:
+                    # every transaction the last dump could not see has
+                    # ended, what is still missing is never coming
+                    gaps = []
+                if state is not None:
+                    first = state[0] + 1
+                cursor.execute(SQL_SELECT_MISSING_IDENTS,
+                               (gaps, first, watermark,))
+                gaps = [row[0] for row in cursor.fetchall()]
+    # only move the watermark once the dump is safely written
+    f.flush()
+    if filename:
+        os.fsync(f.fileno())
+        f.close()
+    if state_file and watermark is not None:
+        write_watermark(state_file, watermark, gaps, snapshot_xmax)
                 
 
 def cli_loader(parser):
@@ -144,8 +351,28 @@ def cli_loader(parser):
     """
     parser.add_argument('--id-select-query', default=DEFAULT_ID_SELECT_QUERY,
                         help='an SQL query that returns module_idents to '
-                             'create sql transfer dumps for'
+                             'create sql transfer dumps for, ordered by '
+                             'module_ident when using --chunk-size, '
                              'default {}'.format(DEFAULT_ID_SELECT_QUERY))
     parser.add_argument('--filename', default=None,
                         help='filename to store sql dump, default stdio')
+    parser.add_argument('--state-file', default=None,
+                        help='file recording the highest module_ident '
+                             'dumped and the ones missing below it, later '
+                             'runs dump only the documents after it and '
+                             'the ones that have since appeared, instead '
+                             'of running the id select query')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='number of documents per chunk of the dump, '
+                             'each loaded on its own, default all of them '
+                             'in one chunk')
+    parser.add_argument('--create-indexes', action='store_true',
+                        help='before dumping, create the indexes on '
+                             'module_files.fileid and modules.abstractid '
+                             'that speed up finding the new files and '
+                             'abstracts, if missing; built concurrently, '
+                             'needs ownership of the tables')
+    parser.add_argument('--itersize', type=int, default=DEFAULT_ITERSIZE,
+                        help='number of idents fetched from the server at '
+                             'a time, default {}'.format(DEFAULT_ITERSIZE))
     return cli_command
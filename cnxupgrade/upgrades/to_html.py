@@ -6,10 +6,18 @@
 # See LICENCE.txt for details.
 # ###
 """Upgrades for munging/transforming Connexions XML formats to HTML."""
+import multiprocessing
+import multiprocessing.util
+import sys
 
 import psycopg2
 
-from cnxarchive.transforms.producers import produce_html_for_module, produce_html_for_abstract
+from cnxarchive.transforms.producers import (
+    produce_html_for_module, produce_html_for_abstract,
+    transform_abstract, transform_module_content)
+
+from .utils import (DEFAULT_ITERSIZE, copy_binary, insert_module_files,
+                    iter_batches, stream_idents, stream_query)
 
 
 __all__ = ('cli_loader',)
@@ -21,40 +29,412 @@ SELECT module_ident FROM modules AS m
                           WHERE module_ident = m.module_ident
                                 AND filename = 'index.cnxml.html');
 """
+# Selects each abstract that is missing its HTML only once,
+#   along with a module that uses it.
+DEFAULT_ABSTRACT_SELECT_QUERY = """\
+SELECT a.abstractid, min(m.module_ident) FROM abstracts AS a
+  JOIN modules AS m ON m.abstractid = a.abstractid
+  WHERE a.html IS NULL
+  GROUP BY a.abstractid
+  ORDER BY a.abstractid;
+"""
+# Same as ``DEFAULT_ABSTRACT_SELECT_QUERY``, for the modules selected by
+#   an id select query, see ``make_abstract_select_query``.
+ABSTRACT_SELECT_QUERY_TEMPLATE = """\
+SELECT a.abstractid, min(m.module_ident) FROM abstracts AS a
+  JOIN modules AS m ON m.abstractid = a.abstractid
+  WHERE a.html IS NULL
+        AND m.module_ident IN ({id_select_query})
+  GROUP BY a.abstractid
+  ORDER BY a.abstractid;
+"""
 DEFAULT_FILENAME = 'index_auto_generated.cnxml'
+# Number of abstracts transformed and written back per transaction.
+DEFAULT_ABSTRACT_BATCH_SIZE = 100
+# Number of idents handed to a worker process at a time.
+WORKER_CHUNK_SIZE = 10
+HTML_FILENAME = 'index.cnxml.html'
+
+# Maps the md5 of a transformed source file and of the module's resources
+#   to the fileid of the HTML that was produced from them, so identical
+#   sources are transformed once. The transform links the resources
+#   a source refers to by filename to the module's own files, hence the
+#   resources are part of the key. References to other documents resolve
+#   the same for every module, and so are left out. An entry goes
+#   with its HTML file, when that is removed by an overwrite.
+SQL_CREATE_TRANSFORM_CACHE = """\
+CREATE TABLE IF NOT EXISTS html_transform_cache (
+  source_md5 TEXT,
+  resources_md5 TEXT,
+  fileid INTEGER NOT NULL REFERENCES files (fileid) ON DELETE CASCADE,
+  PRIMARY KEY (source_md5, resources_md5)
+);
+"""
+# The sources are decoded per module, so one that is not UTF-8 fails
+#   only its own module rather than the query.
+SQL_SELECT_BATCH_SOURCES = """\
+SELECT mf.module_ident, f.file,
+       EXISTS (SELECT 1 FROM module_files
+                 WHERE module_ident = mf.module_ident
+                       AND filename = 'index.cnxml.html')
+FROM module_files AS mf
+     NATURAL JOIN files AS f
+WHERE mf.module_ident = ANY (%s) AND mf.filename = %s
+"""
+SQL_SELECT_BATCH_ABSTRACTS = """\
+SELECT abstractid, abstract FROM abstracts WHERE abstractid = ANY (%s)
+"""
+# The transformed abstracts are loaded into a staging table with
+#   a binary ``COPY`` and written back with one update per batch.
+SQL_CREATE_ABSTRACTS_STAGING = """\
+CREATE TEMP TABLE IF NOT EXISTS abstracts_staging (
+  abstractid INTEGER,
+  html TEXT
+);
+TRUNCATE abstracts_staging;
+"""
+SQL_UPDATE_STAGED_ABSTRACTS = """\
+UPDATE abstracts AS a
+  SET html = s.html
+  FROM abstracts_staging AS s
+  WHERE a.abstractid = s.abstractid;
+"""
+SQL_REMOVE_HTML = """\
+WITH removed AS (
+  DELETE FROM module_files
+  WHERE module_ident = ANY (%s)
+        AND filename = 'index.cnxml.html'
+  RETURNING fileid
+)
+DELETE FROM files AS f
+USING removed
+WHERE f.fileid = removed.fileid
+      AND NOT EXISTS (SELECT 1 FROM module_files
+                        WHERE fileid = removed.fileid);
+"""
+# Selects the md5 of a module's source and resources, the fileid of
+#   the cached HTML (if any) and whether the module already has HTML.
+SQL_LOOKUP_TRANSFORM_CACHE = """\
+WITH resources AS (
+  SELECT md5(coalesce(string_agg(mf.filename || ':' || mf.fileid, '/'
+                                 ORDER BY mf.filename), '')) AS md5
+  FROM module_files AS mf
+  WHERE mf.module_ident = %(ident)s
+        AND mf.filename NOT IN (%(filename)s, 'index.cnxml.html')
+)
+SELECT f.md5, r.md5, c.fileid,
+       EXISTS (SELECT 1 FROM module_files
+                 WHERE module_ident = mf.module_ident
+                       AND filename = 'index.cnxml.html')
+FROM module_files AS mf
+     JOIN files AS f ON f.fileid = mf.fileid
+     CROSS JOIN resources AS r
+     LEFT JOIN html_transform_cache AS c
+               ON c.source_md5 = f.md5 AND c.resources_md5 = r.md5
+WHERE mf.module_ident = %(ident)s AND mf.filename = %(filename)s
+"""
+
+# The database connection used by a worker process,
+#   see ``_init_worker``.
+_worker_connection = None
+
+
+def create_transform_cache(db_connection):
+    """Create the transform cache table, when it does not yet exist."""
+    with db_connection.cursor() as cursor:
+        cursor.execute(SQL_CREATE_TRANSFORM_CACHE)
+    db_connection.commit()
+
+
+def _produce_html_for_module_with_cache(db_connection, cursor, ident,
+                                        source_filename):
+    """Produce the HTML for a module, reusing the HTML file of a previously
+    transformed source file with the same content and resources when
+    there is one.
+    """
+    cursor.execute(SQL_LOOKUP_TRANSFORM_CACHE,
+                   {'ident': ident, 'filename': source_filename})
+    row = cursor.fetchone()
+    if row is None or row[3]:
+        # No source file or the HTML exists, let the producer report on it.
+        return produce_html_for_module(db_connection, cursor, ident,
+                                       source_filename)
+    source_md5, resources_md5, html_fileid, has_html = row
+
+    if html_fileid is not None:
+        # The HTML may have been added meanwhile, which fails only
+        #   this insert rather than the transaction.
+        cursor.execute("SAVEPOINT html_transform_cache")
+        try:
+            cursor.execute("INSERT INTO module_files "
+                           "(module_ident, fileid, filename, mimetype) "
+                           "VALUES (%s, %s, %s, 'text/html')",
+                           (ident, html_fileid, HTML_FILENAME,))
+        except psycopg2.IntegrityError:
+            cursor.execute("ROLLBACK TO SAVEPOINT html_transform_cache")
+            raise
+        cursor.execute("RELEASE SAVEPOINT html_transform_cache")
+        return None
+
+    message = produce_html_for_module(db_connection, cursor, ident,
+                                      source_filename)
+    cursor.execute("SELECT fileid FROM module_files "
+                   "WHERE module_ident = %s AND filename = %s",
+                   (ident, HTML_FILENAME,))
+    row = cursor.fetchone()
+    if row is not None:
+        # Another process may have cached the same source meanwhile,
+        #   which only costs us the duplicate transform.
+        cursor.execute("SAVEPOINT html_transform_cache")
+        try:
+            cursor.execute("INSERT INTO html_transform_cache "
+                           "(source_md5, resources_md5, fileid) "
+                           "VALUES (%s, %s, %s)",
+                           (source_md5, resources_md5, row[0],))
+        except psycopg2.IntegrityError:
+            cursor.execute("ROLLBACK TO SAVEPOINT html_transform_cache")
+        else:
+            cursor.execute("RELEASE SAVEPOINT html_transform_cache")
+    return message
+
+
+def _produce_html_for_module(db_connection, cursor, ident, source_filename,
+                             overwrite_html, use_cache):
+    """Produce the HTML for a single module, optionally through the
+    transform cache. Overwriting always does the transform.
+    """
+    if use_cache and not overwrite_html:
+        return _produce_html_for_module_with_cache(db_connection, cursor,
+                                                   ident, source_filename)
+    return produce_html_for_module(db_connection, cursor, ident,
+                                   source_filename,
+                                   overwrite_html=overwrite_html)
+
+
+def _produce_html_for_batch(db_connection, idents, source_filename,
+                            overwrite_html):
+    """Produce the HTML for a batch of modules. The sources are read in one
+    query, and the transformed HTML is loaded into a staging table with
+    a binary ``COPY``, from which ``files`` and ``module_files`` are
+    filled with set-based inserts. The batch is committed as a whole.
+
+    Returns a list of state tuples, one for each of the given ``idents``.
+    """
+    messages = {}
+    staged = []
+    with db_connection.cursor() as cursor:
+        cursor.execute(SQL_SELECT_BATCH_SOURCES,
+                       (list(idents), source_filename,))
+        sources = dict((ident, (file, has_html,))
+                       for ident, file, has_html in cursor.fetchall())
+        for ident in idents:
+            try:
+                file, has_html = sources[ident]
+            except KeyError:
+                messages[ident] = "Missing source '{}' for ident {}" \
+                                  .format(source_filename, ident)
+                continue
+            cnxml = bytes(file)
+            try:
+                cnxml.decode('utf-8')
+            except UnicodeDecodeError as exc:
+                messages[ident] = "Source '{}' for ident {} is not " \
+                                  "valid UTF-8: {}" \
+                                  .format(source_filename, ident, exc)
+                continue
+            if has_html and not overwrite_html:
+                messages[ident] = "index.cnxml.html already exists " \
+                                  "for ident {}".format(ident)
+                continue
+            try:
+                index_html, message = transform_module_content(
+                    cnxml, db_connection, document_ident=ident)
+            except Exception as exc:
+                message = exc.message
+            else:
+                staged.append((ident, index_html,))
+            messages[ident] = message
+
+        if staged:
+            if overwrite_html:
+                cursor.execute(SQL_REMOVE_HTML,
+                               ([ident for ident, html in staged],))
+            insert_module_files(cursor, staged, HTML_FILENAME, 'text/html')
+    db_connection.commit()
+    return [(ident, messages[ident],) for ident in idents]
+
+
+def _init_worker(connection_string):
+    """Initialize a worker process with its own database connection."""
+    global _worker_connection
+    _worker_connection = psycopg2.connect(connection_string)
+    # Close the connection when the worker process exits.
+    multiprocessing.util.Finalize(None, _worker_connection.close,
+                                  exitpriority=10)
+
+
+def _produce_html_for_module_in_worker(args):
+    """Produce the HTML for a single module within a worker process.
+    Each module is committed (or rolled back) individually, because
+    the worker has no point at which the whole run is known to be done.
+    """
+    ident, source_filename, overwrite_html, use_cache = args
+    db_connection = _worker_connection
+    with db_connection.cursor() as cursor:
+        try:
+            message = _produce_html_for_module(db_connection, cursor, ident,
+                                               source_filename,
+                                               overwrite_html, use_cache)
+        except Exception as exc:
+            db_connection.rollback()
+            message = exc.message
+        else:
+            db_connection.commit()
+    return (ident, message)
+
+
+def _produce_html_for_batch_in_worker(args):
+    """Produce the HTML for a batch of modules within a worker process."""
+    idents, source_filename, overwrite_html = args
+    db_connection = _worker_connection
+    try:
+        return _produce_html_for_batch(db_connection, idents,
+                                       source_filename, overwrite_html)
+    except Exception as exc:
+        db_connection.rollback()
+        return [(ident, exc.message,) for ident in idents]
+
+
+def _produce_html_for_modules_in_parallel(connection_string, idents,
+                                          source_filename, overwrite_html,
+                                          use_cache, workers, batch_size=None):
+    """Distribute the module idents over a pool of ``workers`` processes.
+    Yields the state tuples in the same order as the given ``idents``.
+    When a ``batch_size`` is given, each worker is handed batches of
+    that many idents to write back in bulk.
+    """
+    pool = multiprocessing.Pool(processes=workers,
+                                initializer=_init_worker,
+                                initargs=(connection_string,))
+    try:
+        if batch_size:
+            tasks = ((batch, source_filename, overwrite_html,)
+                     for batch in iter_batches(idents, batch_size))
+            for results in pool.imap(_produce_html_for_batch_in_worker,
+                                     tasks):
+                for result in results:
+                    yield result
+        else:
+            tasks = ((ident, source_filename, overwrite_html, use_cache,)
+                     for ident in idents)
+            for result in pool.imap(_produce_html_for_module_in_worker,
+                                    tasks, WORKER_CHUNK_SIZE):
+                yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 
 def produce_html_for_modules(db_connection,
                              id_select_query=DEFAULT_ID_SELECT_QUERY,
                              source_filename='index.cnxml',
-                             overwrite_html=False):
+                             overwrite_html=False,
+                             workers=1, connection_string=None,
+                             itersize=DEFAULT_ITERSIZE, use_cache=False,
+                             batch_size=None):
     """Produce HTML files of existing module documents. This will
     do the work on all modules in the database.
 
+    When ``workers`` is greater than one, the transforms are done
+    by that many worker processes, each with its own connection made
+    using ``connection_string`` (defaults to the dsn of the given
+    ``db_connection``).
+
+    The idents are streamed from the server ``itersize`` at a time,
+    so work begins before the ``id_select_query`` has been fully read.
+
+    When ``use_cache`` is true, the HTML of a source file is looked up by
+    the source's md5 and linked to the module rather than transformed again.
+
+    When a ``batch_size`` is given (and the cache is not used), the
+    generated HTML is written back and committed ``batch_size`` modules
+    at a time rather than one module at a time.
+
     Yields a state tuple after each module is handled.
     The state tuple contains the id of the document that was transformed
     and either None when no errors have occured
     or a message containing information about the issue.
     """
-    with db_connection.cursor() as cursor:
-        cursor.execute(id_select_query)
-        # Note, the "ident" is different from the "id" in our tables.
-        idents = [v[0] for v in cursor.fetchall()]
+    if use_cache:
+        create_transform_cache(db_connection)
+        batch_size = None
+
+    if workers > 1:
+        if connection_string is None:
+            connection_string = db_connection.dsn
+        # The idents are consumed by the pool's task handler thread,
+        #   so they are read on a connection of their own that is never
+        #   committed, while the workers commit on theirs.
+        ident_connection = psycopg2.connect(connection_string)
+        try:
+            idents = stream_idents(ident_connection, id_select_query,
+                                   itersize=itersize, withhold=False)
+            results = _produce_html_for_modules_in_parallel(
+                connection_string, idents, source_filename, overwrite_html,
+                use_cache, workers, batch_size=batch_size)
+            for result in results:
+                yield result
+        finally:
+            ident_connection.close()
+        raise StopIteration
+
+    # Note, the "ident" is different from the "id" in our tables.
+    idents = stream_idents(db_connection, id_select_query, itersize=itersize)
+
+    if batch_size:
+        for batch in iter_batches(idents, batch_size):
+            # The ident stream is declared within the first batch's
+            #   transaction, so a failed batch is only rolled back to
+            #   its savepoint, which keeps the stream open.
+            with db_connection.cursor() as cursor:
+                cursor.execute("SAVEPOINT html_batch")
+            try:
+                results = _produce_html_for_batch(db_connection, batch,
+                                                  source_filename,
+                                                  overwrite_html)
+            except Exception as exc:
+                with db_connection.cursor() as cursor:
+                    cursor.execute("ROLLBACK TO SAVEPOINT html_batch")
+                db_connection.commit()
+                results = [(ident, exc.message,) for ident in batch]
+            for result in results:
+                yield result
+        raise StopIteration
 
     for ident in idents:
         with db_connection.cursor() as cursor:
+            # A failed module is rolled back on its own, so it does not
+            #   abort the transaction for the modules after it.
+            cursor.execute("SAVEPOINT html_module")
             try:
-                message = produce_html_for_module(db_connection, cursor, ident,
-                                                  source_filename, 
-                                                  overwrite_html=overwrite_html)
+                message = _produce_html_for_module(db_connection, cursor,
+                                                   ident, source_filename,
+                                                   overwrite_html, use_cache)
             except Exception as exc:
+                cursor.execute("ROLLBACK TO SAVEPOINT html_module")
                 message = exc.message
+            else:
+                cursor.execute("RELEASE SAVEPOINT html_module")
         yield (ident, message)
     raise StopIteration
 
 
 def produce_html_for_abstracts(db_connection,
-                               id_select_query=DEFAULT_ID_SELECT_QUERY):
+                               id_select_query=DEFAULT_ID_SELECT_QUERY,
+                               itersize=DEFAULT_ITERSIZE):
     """Produces HTML for abstract content.
 
     Yields a state tuple after each module is handled.
@@ -62,10 +442,8 @@ def produce_html_for_abstracts(db_connection,
     and either None when no errors have occured
     or a message containing information about the issue.
     """
-    with db_connection.cursor() as cursor:
-        cursor.execute(id_select_query)
-        # Note, the "ident" is different from the "id" in our tables.
-        idents = [v[0] for v in cursor.fetchall()]
+    # Note, the "ident" is different from the "id" in our tables.
+    idents = stream_idents(db_connection, id_select_query, itersize=itersize)
 
     for ident in idents:
         with db_connection.cursor() as cursor:
@@ -78,6 +456,97 @@ def produce_html_for_abstracts(db_connection,
     raise StopIteration
 
 
+def make_abstract_select_query(id_select_query):
+    """Returns a query for ``produce_html_for_unique_abstracts`` that
+    selects the abstracts of the modules selected by ``id_select_query``.
+    """
+    id_select_query = id_select_query.strip().rstrip(';')
+    return ABSTRACT_SELECT_QUERY_TEMPLATE.format(
+        id_select_query=id_select_query)
+
+
+def _produce_html_for_abstract_batch(db_connection, rows):
+    """Produce the HTML for a batch of ``(abstractid, module_ident)``
+    ``rows``. The abstracts are read in one query, and the transformed
+    HTML is loaded into a staging table with a binary ``COPY``, from
+    which ``abstracts`` is updated with a single set-based update.
+    The batch is committed as a whole.
+
+    Returns a list of state tuples, one for each of the given ``rows``.
+    """
+    messages = {}
+    staged = []
+    with db_connection.cursor() as cursor:
+        cursor.execute(SQL_SELECT_BATCH_ABSTRACTS,
+                       ([abstractid for abstractid, ident in rows],))
+        abstracts = dict(cursor.fetchall())
+        for abstractid, ident in rows:
+            abstract = abstracts.get(abstractid)
+            if not abstract:
+                # Nothing to transform, like ``produce_html_for_abstract``.
+                messages[abstractid] = None
+                continue
+            # The transform queries the database, a failure is rolled
+            #   back on its own so it does not abort the batch.
+            cursor.execute("SAVEPOINT abstract_transform")
+            try:
+                html, message = transform_abstract(abstract, db_connection,
+                                                   document_ident=ident)
+            except Exception as exc:
+                cursor.execute("ROLLBACK TO SAVEPOINT abstract_transform")
+                message = exc.message
+            else:
+                cursor.execute("RELEASE SAVEPOINT abstract_transform")
+                if html:
+                    if isinstance(html, bytes):
+                        html = html.decode('utf-8')
+                    staged.append((abstractid, html,))
+            messages[abstractid] = message
+
+        if staged:
+            cursor.execute(SQL_CREATE_ABSTRACTS_STAGING)
+            copy_binary(cursor, 'abstracts_staging', ('abstractid', 'html',),
+                        staged)
+            cursor.execute(SQL_UPDATE_STAGED_ABSTRACTS)
+    db_connection.commit()
+    return [(abstractid, messages[abstractid],) for abstractid, ident in rows]
+
+
+def produce_html_for_unique_abstracts(
+        db_connection, abstract_select_query=DEFAULT_ABSTRACT_SELECT_QUERY,
+        itersize=DEFAULT_ITERSIZE, batch_size=DEFAULT_ABSTRACT_BATCH_SIZE):
+    """Produces HTML for abstract content, transforming each abstract
+    only once rather than once per module version that uses it.
+    The ``abstract_select_query`` returns ``(abstractid, module_ident)``
+    rows, where the module is the one given to the transform.
+    The results are written back and committed ``batch_size`` abstracts
+    at a time.
+
+    Yields a state tuple after each abstract is handled.
+    The state tuple contains the id of the abstract that was transformed
+    and either None when no errors have occured
+    or a message containing information about the issue.
+    """
+    rows = stream_query(db_connection, abstract_select_query,
+                        itersize=itersize)
+    for batch in iter_batches(rows, batch_size):
+        # A failed batch is only rolled back to its savepoint, which
+        #   keeps the stream declared within the first batch open.
+        with db_connection.cursor() as cursor:
+            cursor.execute("SAVEPOINT abstract_batch")
+        try:
+            results = _produce_html_for_abstract_batch(db_connection, batch)
+        except Exception as exc:
+            with db_connection.cursor() as cursor:
+                cursor.execute("ROLLBACK TO SAVEPOINT abstract_batch")
+            db_connection.commit()
+            results = [(abstractid, exc.message,)
+                       for abstractid, ident in batch]
+        for result in results:
+            yield result
+    raise StopIteration
+
+
 def cli_command(**kwargs):
     """The command used by the CLI to invoke the upgrade logic."""
     connection_string = kwargs['db_conn_str']
@@ -86,15 +555,38 @@ def cli_command(**kwargs):
     filename = kwargs['filename']
     should_transform_modules = kwargs.get('no_modules', False)
     should_transform_abstracts = kwargs.get('no_abstracts', False)
+    workers = kwargs.get('workers', 1)
+    itersize = kwargs.get('itersize', DEFAULT_ITERSIZE)
+    use_cache = kwargs.get('use_cache', False)
+    unique_abstracts = kwargs.get('unique_abstracts', False)
+    batch_size = kwargs.get('batch_size', None)
+    if use_cache and batch_size:
+        # The batches are transformed without looking in the cache.
+        sys.stderr.write("--batch-size can not be used with --cache\n")
+        return 1
     with psycopg2.connect(connection_string) as db_connection:
         if should_transform_modules:
-            for x in produce_html_for_modules(db_connection, id_select_query,
-                                              source_filename=filename,
-                                              overwrite_html=overwrite_html):
+            for x in produce_html_for_modules(
+                    db_connection, id_select_query,
+                    source_filename=filename,
+                    overwrite_html=overwrite_html,
+                    workers=workers,
+                    connection_string=connection_string,
+                    itersize=itersize,
+                    use_cache=use_cache,
+                    batch_size=batch_size):
                 print x
-        if should_transform_abstracts:
+        if should_transform_abstracts and unique_abstracts:
+           print "Transforming unique abstracts..."
+           abstract_select_query = make_abstract_select_query(
+               id_select_query)
+           for x in produce_html_for_unique_abstracts(
+                   db_connection, abstract_select_query, itersize=itersize):
+               print x
+        elif should_transform_abstracts:
            print "Transforming abstracts..."
-           for x in produce_html_for_abstracts(db_connection, id_select_query):
+           for x in produce_html_for_abstracts(db_connection, id_select_query,
+                                               itersize=itersize):
                print x
 
 
@@ -113,4 +605,21 @@ def cli_loader(parser):
                         help='do not transform modules')
     parser.add_argument('--no-abstracts', action='store_false',
                         help='do not transform abstracts')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used to transform '
+                             'modules, default 1')
+    parser.add_argument('--itersize', type=int, default=DEFAULT_ITERSIZE,
+                        help='number of idents fetched from the server at '
+                             'a time, default {}'.format(DEFAULT_ITERSIZE))
+    parser.add_argument('--cache', dest='use_cache', action='store_true',
+                        default=False,
+                        help='reuse the HTML of previously transformed '
+                             'source files with identical content')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='write back and commit the generated HTML '
+                             'this many modules at a time, not with --cache')
+    parser.add_argument('--unique-abstracts', action='store_true',
+                        default=False,
+                        help='transform each abstract missing its HTML '
+                             'once, rather than by module')
     return cli_command
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# ###
+# Copyright (c) 2013, Rice University
+# This software is subject to the provisions of the GNU Affero General
+# Public License version 3 (AGPLv3).
+# See LICENCE.txt for details.
+# ###
+"""Utilities shared by the upgrade steps."""
+import hashlib
+import struct
+import uuid
+from io import BytesIO
+
+
+__all__ = ('DEFAULT_ITERSIZE', 'stream_query', 'stream_idents',
+           'iter_batches', 'copy_binary', 'insert_module_file',
+           'insert_module_files',)
+
+
+# Number of rows fetched from the server per round-trip.
+DEFAULT_ITERSIZE = 2000
+
+SQL_CREATE_MODULE_FILES_STAGING = """\
+CREATE TEMP TABLE IF NOT EXISTS module_files_staging (
+  module_ident INTEGER,
+  fileid INTEGER,
+  md5 TEXT,
+  file BYTEA,
+  is_new BOOLEAN DEFAULT FALSE
+);
+TRUNCATE module_files_staging;
+"""
+SQL_ASSIGN_STAGED_FILEIDS = """\
+UPDATE module_files_staging
+  SET fileid = nextval(pg_get_serial_sequence('files', 'fileid')),
+      is_new = TRUE;
+"""
+# Point staged files at identical existing files, and give each
+#   distinct remaining file a new fileid.
+SQL_REUSE_STAGED_FILEIDS = """\
+UPDATE module_files_staging AS s
+  SET fileid = (SELECT min(f.fileid) FROM files AS f
+                  WHERE f.md5 = s.md5 AND f.file = s.file);
+WITH new_files AS (
+  SELECT md5, nextval(pg_get_serial_sequence('files', 'fileid')) AS fileid
+  FROM (SELECT DISTINCT md5 FROM module_files_staging
+          WHERE fileid IS NULL) AS d
+)
+UPDATE module_files_staging AS s
+  SET fileid = new_files.fileid, is_new = TRUE
+  FROM new_files
+  WHERE s.fileid IS NULL AND s.md5 = new_files.md5;
+"""
+SQL_INSERT_STAGED_MODULE_FILES = """\
+INSERT INTO files (fileid, file)
+  SELECT DISTINCT ON (fileid) fileid, file FROM module_files_staging
+  WHERE is_new;
+INSERT INTO module_files (module_ident, fileid, filename, mimetype)
+  SELECT module_ident, fileid, %(filename)s, %(mimetype)s
+  FROM module_files_staging;
+"""
+
+
+def stream_query(db_connection, query, params=None,
+                 itersize=DEFAULT_ITERSIZE, withhold=True):
+    """Execute the given ``query`` on a named (server-side) cursor
+    and yield the resulting rows, fetching ``itersize`` rows from the
+    server at a time.
+
+    By default the cursor is declared ``WITH HOLD``, so the caller is
+    free to commit on ``db_connection`` while the rows are being consumed.
+    Note that the first commit makes the server materialize the rest of
+    the result set, so large rows are best read with ``withhold=False``
+    on a connection that is not committed.
+    """
+    # A cursor can only be declared for a single statement
+    #   without the trailing semicolon.
+    query = query.strip().rstrip(';')
+    name = 'stream_{}'.format(uuid.uuid4().hex)
+    cursor = db_connection.cursor(name, withhold=withhold)
+    cursor.itersize = itersize
+    try:
+        cursor.execute(query, params)
+        for row in cursor:
+            yield row
+    finally:
+        if not db_connection.closed:
+            cursor.close()
+
+
+def stream_idents(db_connection, id_select_query,
+                  itersize=DEFAULT_ITERSIZE, params=None, withhold=True):
+    """Yield the first column of each row of the ``id_select_query``,
+    streamed from the server (see ``stream_query``).
+    """
+    for row in stream_query(db_connection, id_select_query, params,
+                            itersize=itersize, withhold=withhold):
+        yield row[0]
+
+
+def iter_batches(iterable, size):
+    """Yield lists of up to ``size`` items from the given ``iterable``."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+_COPY_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_COPY_BINARY_TRAILER = struct.pack('!h', -1)
+
+
+def _encode_copy_binary_value(value):
+    if value is None:
+        return struct.pack('!i', -1)
+    if isinstance(value, bool):
+        data = struct.pack('!?', value)
+    elif isinstance(value, (int, long,)):
+        # Integer columns are expected to be ``int4``.
+        data = struct.pack('!i', value)
+    elif isinstance(value, unicode):
+        data = value.encode('utf-8')
+    else:
+        data = bytes(value)
+    return struct.pack('!i', len(data)) + data
+
+
+def copy_binary(cursor, table, columns, rows):
+    """Load the given ``rows`` into the ``columns`` of ``table`` with
+    a single binary ``COPY``. Values must be ``None``, booleans,
+    integers (for ``int4`` columns), unicode (for ``text`` columns)
+    or byte strings (for ``bytea`` columns).
+    """
+    buffer = BytesIO()
+    buffer.write(_COPY_BINARY_HEADER)
+    for row in rows:
+        buffer.write(struct.pack('!h', len(row)))
+        for value in row:
+            buffer.write(_encode_copy_binary_value(value))
+    buffer.write(_COPY_BINARY_TRAILER)
+    buffer.seek(0)
+    cursor.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT binary)"
+                       .format(table, ', '.join(columns)),
+                       buffer)
+
+
+def insert_module_files(cursor, rows, filename, mimetype,
+                        reuse_files=False):
+    """Insert a file for each of the ``(module_ident, file)`` ``rows``
+    and associate it with the module as ``filename``.
+    The files are loaded into a staging table with a single binary
+    ``COPY`` and then inserted into ``files`` and ``module_files``
+    with set-based statements, rather than a round-trip per row.
+
+    When ``reuse_files`` is true, files are addressed by their md5 and
+    identical contents (existing or within ``rows``) are stored once.
+    """
+    cursor.execute(SQL_CREATE_MODULE_FILES_STAGING)
+    copy_binary(cursor, 'module_files_staging',
+                ('module_ident', 'md5', 'file',),
+                [(ident, hashlib.md5(file).hexdigest(), file,)
+                 for ident, file in rows])
+    if reuse_files:
+        cursor.execute(SQL_REUSE_STAGED_FILEIDS)
+    else:
+        cursor.execute(SQL_ASSIGN_STAGED_FILEIDS)
+    cursor.execute(SQL_INSERT_STAGED_MODULE_FILES,
+                   {'filename': filename, 'mimetype': mimetype})
+
+
+def insert_module_file(cursor, ident, file, filename, mimetype,
+                       reuse_files=False):
+    """Insert a single file and associate it with the module at ``ident``
+    as ``filename``. See ``insert_module_files``.
+    Returns the fileid.
+    """
+    fileid = None
+    if reuse_files:
+        cursor.execute("SELECT min(fileid) FROM files "
+                       "WHERE md5 = %s AND file = %s",
+                       (hashlib.md5(file).hexdigest(), memoryview(file),))
+        fileid = cursor.fetchone()[0]
+    if fileid is None:
+        cursor.execute("INSERT INTO files (file) VALUES (%s) "
+                       "RETURNING fileid;", (memoryview(file),))
+        fileid = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO module_files "
+                   "(module_ident, fileid, filename, mimetype) "
+                   "VALUES (%s, %s, %s, %s);",
+                   (ident, fileid, filename, mimetype,))
+    return fileid
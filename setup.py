@@ -26,7 +26,10 @@ setup(
     description=description,
     packages=find_packages(),
     package_data={'cnxupgrade.upgrades':['*-resources/*',
-                                         'cnxml7/resources/*']
+                                         'cnxml7/resources/*.xsl',
+                                         'cnxml7/resources/dtd/*.rst',
+                                         'cnxml7/resources/dtd/*/*/*/*/*',
+                                         'cnxml7/resources/dtd/*/*/*/*/*/*']
                  },
     install_requires=install_requires,
     tests_require=tests_require,